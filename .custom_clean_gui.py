@@ -20,6 +20,8 @@ from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 
+import rule_tree
+
 appId = 'Custom Clean'
 mainWin = None
 
@@ -109,32 +111,19 @@ class CheckableDirModel(QAbstractItemModel):
 
     def getFSData(self):
         """
-        Return file system data to caller.
+        Return file system data to caller, in the JSON schema.
         """
-        return self.fs_data
+        return rule_tree.to_json(self.fs_data)
 
     def make_file_dict(self, name, rel_path, state, size):
-        file_dict = {}
-        file_dict['name'] = name
-        file_dict['type'] = 'file'
-        file_dict['state'] = state
-        file_dict['rel_path'] = rel_path
-        file_dict['size'] = size
-
-        return file_dict
+        # The tree is kept as rule_tree.RuleNodes, which are much smaller
+        # than dicts; getFSData converts it back to the JSON schema.
+        return rule_tree.RuleNode(name, rule_tree.state_code(state), size, None, rel_path)
 
     def make_dir_dict(self, name, rel_path):
-        dir_dict = {}
-        dir_dict['name'] = name
-        dir_dict['type'] = 'folder'
-        dir_dict['state'] = 'keep'
-        dir_dict['rel_path'] = rel_path
-        dir_dict['children'] = {}
         # We don't try to add up all of the space taken by the dir.
-        # But keep this 'just in case'.
-        dir_dict['size'] = 0
-
-        return dir_dict
+        # But keep the size 'just in case'.
+        return rule_tree.RuleNode(name, rule_tree.KEEP, 0, {}, rel_path)
 
     def handle_patterns(self, dirs):
         # Look for pattern matches in the list of dirs.
@@ -260,16 +249,21 @@ class CheckableDirModel(QAbstractItemModel):
                 size = os.stat(file_path).st_size
                 cur_file_dict = self.make_file_dict(filename, file_rel_path, 'keep', size)
                 # Add this dictionary using the filename as its key.
-                cur_dir_dict['children'][filename] = cur_file_dict
+                cur_dir_dict.add_child(cur_file_dict, filename)
 
             # Use each subdir (-1) in the list of subdirs, as the key to
             # walk down the DB of directories to the level that contains
             # our siblings.
+            parent_dir = None
             sib_dir = fs_data
             for dir in path_as_list[:-1]:
-                sib_dir = sib_dir[dir]['children']
+                parent_dir = sib_dir[dir]
+                sib_dir = parent_dir.children
 
-            sib_dir[cur_dir] = cur_dir_dict
+            if parent_dir is None:
+                sib_dir[cur_dir] = cur_dir_dict
+            else:
+                parent_dir.add_child(cur_dir_dict, cur_dir)
 
         return fs_data
 
@@ -291,7 +285,7 @@ class CheckableDirModel(QAbstractItemModel):
                 state = val['state']
                 rel_path = val['rel_path']
                 size = 0 # this is for the next version; not to worry.
-                parent['children'][name] = self.make_file_dict(name, rel_path, state, size)
+                parent.add_child(self.make_file_dict(name, rel_path, state, size), name)
 
             else:
                 # This is a directory entry. We have no data, except
@@ -307,10 +301,10 @@ class CheckableDirModel(QAbstractItemModel):
                         rel_path = os.path.join(rel_path, path)
 
                 print('KJS: key: %s\t\trel_path:%s' % (key, rel_path))
-                parent['children'][key] = self.make_dir_dict(key, rel_path)
+                parent.add_child(self.make_dir_dict(key, rel_path), key)
                 # Send the next level of old data, next level of new data,
                 # and the new path.
-                self.pop_model_from_data(val, parent['children'][key], rel_path_list)
+                self.pop_model_from_data(val, parent.children[key], rel_path_list)
 
                 # Pop this key back off the list.
                 rel_path_list.pop()
@@ -11,15 +11,40 @@
 import sys
 import os
 import shutil
+import copy
 import json
 import argparse
 import glob
+import stat
 import re
-import fnmatch
+import ctypes
+import ctypes.util
+import errno
+import select
+import signal
+import struct
+import time
+import gzip
+import lzma
+import tempfile
+import tarfile
+import concurrent.futures
+import multiprocessing
+import heapq
+import collections
+import hashlib
+import socket
+import socketserver
+import threading
+
+import rule_tree
 
 files_to_delete = []
 dirs_to_delete = []
 
+# Folder being cleaned, always ending in '/'. Set in main().
+base_path = ''
+
 PROG = 'CustomClean'
 VERSION = '2.0.3'
 
@@ -36,56 +61,225 @@ def get_parser():
     #parser = argparse.ArgumentParser(description=program_desc, prog=PROG, version=VERSION)
     parser = argparse.ArgumentParser(description=program_desc, prog=PROG)
 
-    parser.add_argument('-j', '--json', dest='json', required=True,
+    parser.add_argument('-j', '--json', dest='json', required=False, action='append',
                         help="""Absolute path to a cleaning JSON as created by the CustomClean
-GUI.""")
+GUI. May be given more than once to apply several rule sets in one pass.
+Required unless --serve or --status is used.""")
 
-    parser.add_argument('-d', '--dir', dest='dir', required=True,
+    parser.add_argument('-d', '--dir', dest='dir', required=False,
                         help="""Absolute path to a folder that needs cleaning.
-Should have an identical folder structure to the one in the cleaning JSON.""")
+Should have an identical folder structure to the one in the cleaning JSON.
+Required unless --archive is used.""")
 
     parser.add_argument('-p', '--pattern', dest='pattern', required=False,
                         help="""Pattern string for names that should be
 treated identically. E.g. task-rest* will cause task-rest01, task-rest02, etc. to
 follow deletion pattern given for task-rest01 in the cleaning JSON.""")
 
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help="""Keep running and watch the folder with inotify (Linux
+only). Paths that match a delete rule are removed as soon as they are closed
+for writing, or once nothing has touched them for --quiet-period seconds.
+SIGINT or SIGTERM stops watching and does a final full cleaning pass.""")
+
+    parser.add_argument('--quiet-period', dest='quiet_period', type=float,
+                        default=60.0,
+                        help="""Seconds without activity before a matching path
+is removed in --watch mode. Default: %(default)s.""")
+
+    parser.add_argument('--max-pending', dest='max_pending', type=int,
+                        default=10000,
+                        help="""Most paths --watch mode will queue for removal at
+once. Past that, events are dropped and the folder is re-scanned once the
+queue drains. Default: %(default)s.""")
+
+    parser.add_argument('--paths-from', dest='paths_from', required=False,
+                        help="""Read the paths to check from this file ('-' for
+stdin) instead of looking through the folder, e.g. the output of find or lfs find.
+Absolute paths must be under the folder given with -d; relative paths are taken
+as relative to it. Each path that matches a delete rule is removed.""")
+
+    parser.add_argument('-0', '--null', dest='null', action='store_true',
+                        help="""Paths read with --paths-from are separated by NUL
+characters (find -print0) instead of newlines.""")
+
+    parser.add_argument('--print-matches', dest='print_matches', action='store_true',
+                        help="""With --paths-from, print the paths that would be
+removed to stdout (using the same separator as the input) instead of removing
+them.""")
+
+    parser.add_argument('--compress-format', dest='compress_format',
+                        choices=sorted(COMPRESSORS), default='gzip',
+                        help="""How to compress files whose state is 'compress'.
+Default: %(default)s.""")
+
+    parser.add_argument('--jobs', dest='jobs', type=int, default=os.cpu_count(),
+                        help="""Number of processes used to compress files, and
+of threads used to measure sizes for --free-target. With --serve, the number
+of processes all requests compress on. Default: number of CPUs (%(default)s).""")
+
+    parser.add_argument('--archive', dest='archive', required=False,
+                        help="""Clean a .tar archive (optionally compressed)
+instead of a folder. Members are read one at a time and never extracted;
+the ones that match a delete rule are left out of --archive-out.""")
+
+    parser.add_argument('--archive-out', dest='archive_out', required=False,
+                        help="""Where to write the cleaned archive. The
+extension (.tar, .tar.gz/.tgz, .tar.bz2, .tar.xz) sets the compression.""")
+
+    parser.add_argument('--archive-manifest', dest='archive_manifest', required=False,
+                        help="""Where to list the members that were left out.
+Default: the --archive-out path plus .dropped.txt.""")
+
+    parser.add_argument('--strip-components', dest='strip_components', type=int,
+                        default=0,
+                        help="""Number of leading folders in archive member
+names to ignore when matching rules, as in tar. Default: %(default)s.""")
+
+    parser.add_argument('--precedence', dest='precedence', choices=('delete', 'keep'),
+                        default='delete',
+                        help="""What wins when one cleaning JSON deletes a path
+that another one keeps. 'delete' (the default) gives the same result as running
+the JSONs one after the other. With 'keep', a path that some JSON keeps is never
+removed, and a deleted folder that holds it is removed around it. A JSON's keep
+rules inside folders it deletes itself are ignored.""")
+
+    parser.add_argument('--free-target', dest='free_target', type=parse_size,
+                        required=False,
+                        help="""Only remove enough to free this many bytes
+(K, M, G and T suffixes are powers of 1024), biggest first. Sizes come from the
+JSON where it has them and from the file system otherwise. What was left in
+place is listed in the success record. Files are not compressed in this mode.""")
+
+    parser.add_argument('--memory-cap', dest='memory_cap', type=parse_size, required=False,
+                        help="""Keep memory use for the list of paths to remove
+under about this many bytes (K, M, G and T suffixes are powers of 1024) by
+sorting it in pieces on disk. For cleaning very large folders.""")
+
+    parser.add_argument('--spill-dir', dest='spill_dir', required=False,
+                        help="""Folder for the sorted pieces written with
+--memory-cap. Default: the system temp folder.""")
+
+    parser.add_argument('--rule-stats', dest='rule_stats', metavar='STATS_JSON', required=False,
+                        help="""Keep hit counts and match times for every rule
+and pattern in this file, over runs. Rules are then expanded and matched
+cheapest first (targets are still removed files first), and patterned rules
+that matched nothing last time are not expanded again until one of the
+folders they look in changes. Only for normal cleaning runs.""")
+
+    parser.add_argument('--rule-report', dest='rule_report', action='store_true',
+                        help="""Print the rules that never matched anything, the
+patterns that never changed a rule, rules inside a folder another rule
+removes, and the slowest rules. Needs --rule-stats. Without -d nothing is
+cleaned.""")
+
+    parser.add_argument('--serve', dest='serve', metavar='SOCKET', required=False,
+                        help="""Run as a daemon that cleans folders for clients
+connecting to this Unix socket (see --connect). Compiled rules are cached
+between requests.""")
+
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=32,
+                        help="""Number of compiled rule sets the daemon keeps.
+Default: %(default)s.""")
+
+    parser.add_argument('--max-deletes', dest='max_deletes', type=int, default=4,
+                        help="""Number of requests the daemon removes files for
+at the same time, over all clients. Default: %(default)s.""")
+
+    parser.add_argument('--checksum-manifest', dest='checksum_manifest', required=False,
+                        help="""Write a checksum of every file that is kept to
+this file (path, size, mtime and digest, separated by tabs). Hashing is done
+while the folder is walked for deletions, so the folder is only read once.
+If the file already exists, digests of files whose size and mtime have not
+changed are reused.""")
+
+    parser.add_argument('--checksum-algorithm', dest='checksum_algorithm', default='sha256',
+                        choices=sorted(hashlib.algorithms_guaranteed),
+                        help="""Digest for --checksum-manifest. Default: %(default)s.""")
+
+    parser.add_argument('--connect', dest='connect', metavar='SOCKET', required=False,
+                        help="""Send the request to the daemon listening on this
+Unix socket instead of doing the work here.""")
+
+    parser.add_argument('--plan', dest='plan', action='store_true',
+                        help="""With --connect, only print the paths that would
+be removed.""")
+
+    parser.add_argument('--status', dest='status', action='store_true',
+                        help="""With --connect, print the daemon's status.""")
+
     return parser
 
+def parse_size(text):
+    # '1000', '500M', '2.5T' -> bytes.
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    number = text.strip().upper().rstrip('B')
+    multiplier = 1
+    if number and (number[-1] in units):
+        multiplier = units[number[-1]]
+        number = number[:-1]
+    try:
+        return int(float(number) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError('not a size: %s' % text)
+
 def is_dir(d):
-    if ('folder' == d['type']):
-        return True
-    else:
-        return False
+    return d.is_dir()
 
 def is_file(d):
-    if ('file' == d['type']):
-        return True
-    else:
-        return False
+    return not d.is_dir()
 
-def get_files_to_delete(d):
-    # files_to_delete is a global list.
+def get_files_to_delete(d, target=files_to_delete):
+    # d is a dict of rule_tree.RuleNodes.
+    # By default, files go in the global list files_to_delete.
     for k, v in d.items():
         if is_dir(v):
-            get_files_to_delete(v['children'])
+            get_files_to_delete(v.children, target)
         else:
-            if 'delete' == v['state']:
-                files_to_delete.append(v['rel_path'])
+            if rule_tree.DELETE == v.state:
+                target.append(v.rel_path())
 
-def get_dirs_to_delete(d):
-    # dirs_to_delete is a global list.
+def get_dirs_to_delete(d, target=dirs_to_delete):
+    # By default, dirs go in the global list dirs_to_delete.
     for k, v in d.items():
         if is_dir(v):
-            if 'delete' == v['state']:
-                dirs_to_delete.append(v['rel_path'])
-            get_dirs_to_delete(v['children'])
+            if rule_tree.DELETE == v.state:
+                target.append(v.rel_path())
+            get_dirs_to_delete(v.children, target)
+
+def node_size(v):
+    # The JSON's size for a node, or 0 if it has none.
+    try:
+        return int(v.size)
+    except (TypeError, ValueError):
+        return 0
+
+def get_size_hints(d, hints):
+    # Sizes from the JSON for each file to delete, keyed by its rel_path. A
+    # hint only stands for that exact file, not for what a pattern made of
+    # it matches. Folders have no size in the JSON and are measured.
+    for k, v in d.items():
+        if is_dir(v):
+            get_size_hints(v.children, hints)
+        elif (rule_tree.DELETE == v.state) and (node_size(v) > 0):
+            hints[v.rel_path()] = node_size(v)
+
+def get_paths_with_state(d, state, target):
+    # Files and dirs whose state is state (a rule_tree constant), top down.
+    for k, v in d.items():
+        if state == v.state:
+            target.append(v.rel_path())
+        if is_dir(v):
+            get_paths_with_state(v.children, state, target)
 
 
 
-def remove(target_paths):
+def remove(target_paths, sources=None):
     """
     Takes a list of paths to be removed/deleted/unlinked and returns information on which ones were
     able to be deleted and which were not.
+    If given, sources maps each path to the rule set that caused it, which is
+    added to its success line.
     """
 
     not_found = 'Expected and could not find: '
@@ -93,43 +287,55 @@ def remove(target_paths):
 
     for p in target_paths:
         str_p = str(p)
+        note = ''
+        if sources is not None:
+            note = ' (rule set: %s)' % sources[p]
 
         if os.path.isdir(str_p):
             try:
                 shutil.rmtree(str_p)
-                success += 'Removed directory ' + str_p + '\n'
+                success += 'Removed directory ' + str_p + note + '\n'
+            except FileNotFoundError:
+                # Someone else removed it first.
+                not_found += '\n' + str_p
             except IOError as err:
                 sys.stderr.write('You do not have permissions to delete all of the specified directories.')
                 sys.stderr.write('IOError: %s.' % err)
-                sys.exit(code=1)
+                sys.exit(1)
             except OSError as err:
                 sys.stderr.write('You do not have permissions to delete all of the specified directories.')
                 sys.stderr.write('OSError: %s.' % err)
-                sys.exit(code=1)
+                sys.exit(1)
         elif os.path.islink(str_p):
             try:
                 os.unlink(str_p)
-                success += 'Unlinked ' + str_p + '\n'
+                success += 'Unlinked ' + str_p + note + '\n'
+            except FileNotFoundError:
+                # Someone else removed it first.
+                not_found += '\n' + str_p
             except IOError as err:
                 sys.stderr.write('You do not have permissions to delete all of the specified links.')
                 sys.stderr.write('IOError: %s.' % err)
-                sys.exit(code=1)
+                sys.exit(1)
             except OSError as err:
                 sys.stderr.write('You do not have permissions to delete all of the specified links.')
                 sys.stderr.write('OSError: %s.' % err)
-                sys.exit(code=1)
+                sys.exit(1)
         elif os.path.isfile(str_p):
             try:
                 os.remove(str_p)
-                success += 'Removed file ' + str_p + '\n'
+                success += 'Removed file ' + str_p + note + '\n'
+            except FileNotFoundError:
+                # Someone else removed it first.
+                not_found += '\n' + str_p
             except IOError as err:
                 sys.stderr.write('You do not have permissions to delete all of the specified files.')
                 sys.stderr.write('IOError: %s.' % err)
-                sys.exit(code=1)
+                sys.exit(1)
             except OSError as err:
                 sys.stderr.write('You do not have permissions to delete all of the specified files.')
                 sys.stderr.write('OSError: %s.' % err)
-                sys.exit(code=1)
+                sys.exit(1)
         else:
             not_found += '\n' + str_p
 
@@ -137,40 +343,37 @@ def remove(target_paths):
 
 
 
-def apply_patterns(items_to_delete, pattern_list):
+def apply_patterns(items_to_delete, pattern_list, stats=None):
     # Handle patterns. Replace all matches in the paths.
     # Note: we make * match any number of numbers and nothing else.
+    # If stats (a RuleStats) is given, each pattern's hits and time go there.
 
-    # Start with a copy of the items to be deleted.
-    cur_items = set()
-    cur_items.update(items_to_delete)
+    # Start with a copy of the items to be deleted. A dict keeps them in
+    # order and drops duplicates.
+    cur_items = dict.fromkeys(items_to_delete)
 
     for pattern in pattern_list:
-        remove_items = set()
-        new_items = set()
+        start = time.perf_counter()
+        new_items = {}
+        replaced = 0
 
         # Make * match digits and nothing else.
         re_pattern = re.compile(pattern.replace('*', '[0-9]+'))
 
         for path in cur_items:
-            # Replace all matches of re_pattern with pattern.
+            # Replace all matches of re_pattern with pattern. The patterned
+            # path takes the place of the first path it stands for.
             new_path, subs = re.subn(re_pattern, re_pattern.pattern, path)
             if subs:
-                new_items.add(new_path)
+                replaced += 1
+            new_items.setdefault(new_path)
 
-                # Save the original string to a list to be removed from
-                # cur_items, outside of the loop. (Never change the loop
-                # variable inside of the loop.)
-                remove_items.add(path)
+        cur_items = new_items
 
-        # The paths in 'remove_items' are being replaced with one or more patterns.
-        for item in remove_items:
-            cur_items.remove(item)
+        if stats is not None:
+            stats.record_pattern(pattern, replaced, time.perf_counter() - start)
 
-        # Add the new paths.
-        cur_items.update(new_items)
-
-    return cur_items
+    return list(cur_items)
 
 def expand_path(path_to_expand):
     # The patterns to be expanded are regex patterns. But glob does not handle
@@ -190,13 +393,23 @@ def expand_path(path_to_expand):
         print ('There were no glob paths matching the pattern:\n\t%s' % abs_path)
 
     else:
-        re_match_pattern = re.compile(fnmatch.translate(abs_path))
+        re_match_pattern = re.compile(rule_to_regex(abs_path) + '\\Z')
         for path in glob_list:
             if re_match_pattern.match(path) is not None:
                 match_set.add(path)
 
     return match_set
 
+def iter_expand_path(path_to_expand):
+    # Like expand_path, but yields the matches one at a time (glob.iglob)
+    # instead of collecting them.
+    abs_path = os.path.join(base_path, path_to_expand)
+    re_match_pattern = re.compile(rule_to_regex(abs_path) + '\\Z')
+
+    for path in glob.iglob(abs_path.replace('[0-9]+', '*')):
+        if re_match_pattern.match(path) is not None:
+            yield path
+
 
 
 def make_paths(paths_to_delete):
@@ -217,60 +430,1889 @@ def make_paths(paths_to_delete):
     return abs_paths
 
 
-if __name__ == '__main__':
 
-    parser = get_parser()
+# Extension and opener for each --compress-format.
+COMPRESSORS = {
+    'gzip': ('.gz', lambda f: gzip.GzipFile(fileobj=f, mode='wb')),
+    'xz': ('.xz', lambda f: lzma.LZMAFile(f, 'wb')),
+}
 
-    args = parser.parse_args()
-    json_data = {}
-    pattern_list = []
+# Files that start with one of these (gzip, xz, bzip2, zstd, zip) are
+# already compressed and are left alone.
+COMPRESSED_MAGIC = (b'\x1f\x8b', b'\xfd7zXZ\x00', b'BZh', b'\x28\xb5\x2f\xfd', b'PK\x03\x04')
+COMPRESSED_EXTENSIONS = ('.gz', '.xz', '.bz2', '.zst', '.zip')
 
-    # Argument is path to JSON, and, optionally, a single pattern.
-    # JSON data may contain patterns as well. If the user supplies a pattern,
-    # it will be added to the list.
+def fsync_dir(dir_path):
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def compress_file(path, compress_format):
+    """
+    Compresses one file into path + .gz (or .xz), and removes the original.
+    The data is streamed into a temp file in the same directory, which is
+    fsynced and then renamed into place, so a crash never leaves a partial
+    file under the final name. Runs in a worker process.
+    Returns the compressed path and the bytes saved; the path is None if the
+    file was already compressed or would not get any smaller.
+    """
+    extension, open_compressed = COMPRESSORS[compress_format]
+    out_path = path + extension
+    dir_path = os.path.dirname(path)
+
+    with open(path, 'rb') as src:
+        if src.read(6).startswith(COMPRESSED_MAGIC):
+            return None, 0
+        src.seek(0)
+
+        if os.path.lexists(out_path):
+            raise FileExistsError(errno.EEXIST, 'Will not overwrite', out_path)
+
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.' + os.path.basename(path) + '.',
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                with open_compressed(tmp) as compressed:
+                    shutil.copyfileobj(src, compressed, 1024 * 1024)
+                tmp.flush()
+                saved = os.fstat(src.fileno()).st_size - os.fstat(tmp.fileno()).st_size
+                if saved <= 0:
+                    # Not worth it (tiny or incompressible file).
+                    os.unlink(tmp_path)
+                    return None, 0
+                os.fsync(tmp.fileno())
+            shutil.copystat(path, tmp_path)
+            os.rename(tmp_path, out_path)
+        except BaseException:
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    os.unlink(path)
+    fsync_dir(dir_path)
+
+    return out_path, saved
+
+def compress(target_paths, compress_format, jobs, pool=None):
+    """
+    Compresses every file in target_paths (and every file inside a directory
+    in target_paths) on a pool of jobs processes, or on pool if given.
+    Returns lines for the not-found message, the success message, and the
+    number of files that could not be compressed (those are reported on
+    stderr as they happen).
+    """
+
+    not_found = ''
+    success = ''
+    failures = 0
+    total_saved = 0
+
+    files = []
+    for p in sorted(target_paths):
+        if os.path.islink(p):
+            continue
+        elif os.path.isdir(p):
+            for cur_path, dirs, filenames in os.walk(p):
+                for filename in filenames:
+                    files.append(os.path.join(cur_path, filename))
+        elif os.path.isfile(p):
+            files.append(p)
+        elif any(os.path.isfile(p + ext) for ext, opener in COMPRESSORS.values()):
+            # Compressed by an earlier run.
+            continue
+        else:
+            not_found += '\n' + p
+
+    # Skip the obvious ones without starting a process for them.
+    files = [f for f in files if not (f.endswith(COMPRESSED_EXTENSIONS) or os.path.islink(f))]
+    if not files:
+        return not_found, success, failures
+
+    own_pool = pool is None
+    if own_pool:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    try:
+        futures = {}
+        for f in files:
+            futures[pool.submit(compress_file, f, compress_format)] = f
+
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                out_path, saved = future.result()
+            except OSError as err:
+                sys.stderr.write('Could not compress %s.\n' % path)
+                sys.stderr.write('OSError: %s.\n' % err)
+                failures += 1
+                continue
+
+            if out_path is not None:
+                success += 'Compressed file %s to %s, saved %d bytes\n' % (path, out_path, saved)
+                total_saved += saved
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+    if success:
+        success += 'Compression saved %d bytes in total\n' % total_saved
+
+    return not_found, success, failures
+
+
+def rule_to_regex(rule_path):
+    # Turn a path as returned by apply_patterns into a regex string.
+    # [0-9]+ matches one or more digits, * matches anything within one path
+    # component, and everything else is literal.
+    regex = ''
+    for piece in re.split(r'(\[0-9\]\+|\*)', rule_path):
+        if '[0-9]+' == piece:
+            regex += '[0-9]+'
+        elif '*' == piece:
+            regex += '[^/]*'
+        else:
+            regex += re.escape(piece)
+
+    return regex
+
+def compile_paths(paths):
+    # Splits paths into a set of plain ones and a list of patterned ones, and
+    # builds one regex that matches any patterned one, each in its own group.
+    exact = set()
+    patterned = []
+
+    for path in paths:
+        path = path.strip('/')
+        if ('*' in path) or ('[0-9]' in path):
+            patterned.append(path)
+        else:
+            exact.add(path)
+
+    regex = None
+    if patterned:
+        groups = ['(%s)' % rule_to_regex(path) for path in patterned]
+        regex = re.compile('(?:%s)\\Z' % '|'.join(groups))
+
+    return exact, patterned, regex
+
+class RuleMatcher(object):
+    """
+    Compiled form of the relative paths returned by apply_patterns. Tells
+    whether a relative path would be removed, without looking at the file
+    system: a path matches if it, or any directory above it, is a rule.
+    Paths in keep_paths are never removed, nor are the directories above
+    them; a deleted directory that holds a kept path is removed piece by
+    piece around it. sources maps each rule to the rule set it came from.
+    """
+
+    def __init__(self, rule_paths, keep_paths=(), sources=None):
+        self.sources = sources or {}
+        self.exact, self.patterned, self.regex = compile_paths(rule_paths)
+
+        keep_above = set()
+        for path in keep_paths:
+            parts = path.strip('/').split('/')
+            for i in range(1, len(parts)):
+                keep_above.add('/'.join(parts[:i]))
+
+        self.has_keeps = bool(keep_paths)
+        self.keep_exact, _, self.keep_regex = compile_paths(keep_paths)
+        self.above_exact, _, self.above_regex = compile_paths(keep_above)
+
+    def rule_for(self, path):
+        # The rule that names path itself, or None.
+        if path in self.exact:
+            return path
+        if self.regex is not None:
+            m = self.regex.match(path)
+            if m is not None:
+                return self.patterned[m.lastindex - 1]
+        return None
+
+    def is_kept(self, path):
+        if path in self.keep_exact:
+            return True
+        return (self.keep_regex is not None) and (self.keep_regex.match(path) is not None)
+
+    def holds_kept(self, path):
+        # True if path is a directory with a kept path somewhere inside.
+        if path in self.above_exact:
+            return True
+        return (self.above_regex is not None) and (self.above_regex.match(path) is not None)
+
+    def match_rule(self, rel_path):
+        """
+        Returns the topmost prefix of rel_path that should be removed, and
+        the rule that causes it, or (None, None).
+        """
+        rule = None
+        prefix = ''
+        for part in rel_path.strip('/').split('/'):
+            if prefix:
+                prefix = prefix + '/' + part
+            else:
+                prefix = part
+
+            if rule is None:
+                rule = self.rule_for(prefix)
+                if rule is None:
+                    continue
+
+            # Inside a deleted directory, but this part has to stay.
+            if self.has_keeps and (self.is_kept(prefix) or self.holds_kept(prefix)):
+                continue
+
+            return prefix, rule
+
+        return None, None
+
+    def match(self, rel_path):
+        return self.match_rule(rel_path)[0]
+
+    def source(self, rule):
+        return self.sources.get(rule)
+
+
+def spare_kept(dir_path, matcher):
+    # The paths to remove instead of dir_path, so that the kept paths inside
+    # it survive. Kept directories stay, but not necessarily their contents.
+    targets = []
+    for entry in os.scandir(dir_path):
+        rel_path = os.path.relpath(entry.path, base_path)
+        if matcher.is_kept(rel_path) or matcher.holds_kept(rel_path):
+            if entry.is_dir(follow_symlinks=False):
+                targets.extend(spare_kept(entry.path, matcher))
+        else:
+            targets.append(entry.path)
+
+    return targets
+
+def make_targets(patterned_paths, matcher, stats=None):
+    """
+    Like make_paths, but returns a dict of absolute path -> the rule that
+    caused it, and leaves out (or works around) paths that are kept.
+    With stats (a RuleStats), the rules are expanded cheapest first, each
+    rule's hits and time are recorded, and rules known to be dead in this
+    folder are not expanded. The targets still come back in the order of
+    patterned_paths, so files go before the folders they are in.
+    """
+    targets = {}
+    rules = patterned_paths
+    if stats is not None:
+        rules = sorted(patterned_paths, key=stats.order_key)
+
+    for rule in rules:
+        if stats is None:
+            rule_paths = make_paths([rule])
+        elif stats.is_dead(rule):
+            stats.record_skip(rule)
+            continue
+        else:
+            start = time.perf_counter()
+            rule_paths = make_paths([rule])
+            if is_patterned(rule):
+                hits = len(rule_paths)
+            else:
+                hits = sum(1 for p in rule_paths if os.path.lexists(p))
+            stats.record_rule(rule, hits, time.perf_counter() - start)
+
+        for abs_path in rule_paths:
+            if matcher.has_keeps:
+                rel_path = os.path.relpath(abs_path, base_path)
+                # Like match_rule: a kept folder stays, but not what is in it.
+                if matcher.is_kept(rel_path) or matcher.holds_kept(rel_path):
+                    if os.path.isdir(abs_path) and not os.path.islink(abs_path):
+                        for p in spare_kept(abs_path, matcher):
+                            targets.setdefault(p, rule)
+                    continue
+            targets.setdefault(abs_path, rule)
+
+    if stats is not None:
+        # Back to removal order: file rules first, folders deepest first.
+        position = {rule: i for i, rule in enumerate(patterned_paths)}
+        targets = dict(sorted(targets.items(), key=lambda t: position[t[1]]))
+
+    return targets
+
+def path_size(path):
+    # Size in bytes of a file or link, or of everything in a directory.
     try:
-        with open(args.json) as j:
-            whole_json_data = json.load(j)
+        st = os.lstat(path)
+    except OSError:
+        return 0
+    if not stat.S_ISDIR(st.st_mode):
+        return st.st_size
+
+    total = 0
+    for cur_path, dirs, files in os.walk(path):
+        for filename in files:
+            try:
+                total += os.lstat(os.path.join(cur_path, filename)).st_size
+            except OSError:
+                pass
+
+    return total
+
+def estimate_sizes(targets, size_hints, jobs):
+    """
+    Estimates the size of each target (a dict from make_targets). The JSON's
+    size is used if the target is exactly the file it was given for;
+    everything else is measured on a pool of jobs threads.
+    Returns a dict of target -> size in bytes.
+    """
+    sizes = {}
+    to_measure = []
+
+    for p in targets:
+        rel_path = os.path.relpath(p, base_path)
+        if rel_path in size_hints:
+            sizes[p] = size_hints[rel_path]
+        else:
+            to_measure.append(p)
+
+    if to_measure:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            for p, size in zip(to_measure, pool.map(path_size, to_measure)):
+                sizes[p] = size
+
+    return sizes
+
+def drop_nested(targets):
+    # The targets (a dict from make_targets) that are not inside another
+    # target. Sorted by path_key, a directory comes right before its
+    # contents, so comparing with the last one kept is enough.
+    outer = {}
+    last_key = None
+    for key, p in sorted((path_key(p), p) for p in targets):
+        if (last_key is not None) and ((key == last_key) or key.startswith(last_key + b'\0')):
+            continue
+        last_key = key
+        outer[p] = targets[p]
+
+    return outer
+
+def free_space(targets, sizes, free_target, sources=None):
+    """
+    Removes targets, biggest first, until about free_target bytes have been
+    freed. Targets must not be inside each other (see drop_nested).
+    Returns the same (not_found, success) pair as remove(); the success
+    message ends with how much was freed and what was left in place.
+    """
+
+    not_found = 'Expected and could not find: '
+    success = ''
+    freed = 0
+    left = []
+
+    for p in sorted(targets, key=lambda p: sizes[p], reverse=True):
+        if freed >= free_target:
+            left.append(p)
+            continue
+        missing, removed = remove([p], sources)
+        if '\n' in missing:
+            not_found += '\n' + p
+        else:
+            success += removed
+            freed += sizes[p]
+
+    success += 'Freed about %d bytes (target %d bytes)\n' % (freed, free_target)
+    if left:
+        success += 'Left in place:\n'
+        for p in left:
+            success += '\t%s (about %d bytes)\n' % (p, sizes[p])
+
+    if freed < free_target:
+        sys.stderr.write('Could only free about %d of the %d bytes asked for.\n' % (freed, free_target))
+
+    return not_found, success
+
+def iter_targets(rule_paths, matcher):
+    # Like make_targets, but yields (absolute path, index of its rule in
+    # rule_paths) one at a time. The same path may come up more than once.
+    for rule_index, rule in enumerate(rule_paths):
+        if ('*' in rule) or ('[0-9]' in rule):
+            abs_paths = iter_expand_path(rule)
+        else:
+            abs_paths = [os.path.join(base_path, rule)]
+
+        for abs_path in abs_paths:
+            if matcher.has_keeps:
+                rel_path = os.path.relpath(abs_path, base_path)
+                if matcher.is_kept(rel_path) or matcher.holds_kept(rel_path):
+                    if os.path.isdir(abs_path) and not os.path.islink(abs_path):
+                        for p in spare_kept(abs_path, matcher):
+                            yield p, rule_index
+                    continue
+            yield abs_path, rule_index
+
+def target_sources(targets, matcher):
+    # Maps each target to the name of the rule set that caused it, for remove().
+    sources = {}
+    for p, rule in targets.items():
+        sources[p] = matcher.source(rule)
+
+    return sources
+
+
+
+# inotify(7) constants, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyWatcher(object):
+    """
+    Minimal ctypes wrapper around the Linux inotify API. One watch is added
+    per directory; events come back as (absolute path, mask) pairs.
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.wd_paths = {}
+        # Set when a directory could not be watched; see add_watch.
+        self.unwatched = False
+        self.warned = set()
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # Gone (or replaced by a file) before we got to it.
+                return
+            # Out of watches (ENOSPC, see fs.inotify.max_user_watches), no
+            # permission, ...: nothing in here sends events, so the caller
+            # has to re-scan for it. Warn once per kind of error.
+            if err not in self.warned:
+                self.warned.add(err)
+                sys.stderr.write('Could not watch %s: %s. Folders that cannot be watched '
+                                 'are re-scanned every quiet period.\n' % (path, os.strerror(err)))
+            self.unwatched = True
+            return
+        self.wd_paths[wd] = path
+
+    def read_events(self, timeout):
+        """
+        Waits up to timeout seconds, then returns every event that is queued.
+        """
+        events = []
+        if not self.poller.poll(timeout * 1000):
+            return events
+
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+                offset += EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & IN_IGNORED:
+                    self.wd_paths.pop(wd, None)
+                    continue
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                    continue
+
+                dir_path = self.wd_paths.get(wd)
+                if dir_path is None:
+                    continue
+                events.append((os.path.join(dir_path, os.fsdecode(name)), mask))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def queue_target(pending, target, deadline, max_pending):
+    # Coalesce events: each target is queued once, and only its deadline
+    # moves. A deadline of 0 means 'remove now' and is never pushed back.
+    # Returns False if the queue is full and the target had to be dropped.
+    if target in pending:
+        if pending[target]:
+            pending[target] = deadline
+        return True
+    if len(pending) >= max_pending:
+        return False
+    pending[target] = deadline
+    return True
+
+def watch_tree(top, watcher, matcher, pending, deadline, max_pending):
+    # Add watches for top and every directory below it, and queue whatever is
+    # already covered by a rule. Paths that appeared before their directory
+    # was watched never produce an event, so this walk is the only way to
+    # see them. Returns False if anything was dropped.
+    complete = True
+
+    for cur_path, dirs, files in os.walk(top):
+        watcher.add_watch(cur_path)
+
+        rel_path = os.path.relpath(cur_path, base_path)
+        if '.' != rel_path:
+            target = matcher.match(rel_path)
+            if target is not None:
+                target = os.path.join(base_path, target)
+                complete = queue_target(pending, target, deadline, max_pending) and complete
+
+        for filename in files:
+            target = matcher.match(os.path.join(rel_path, filename))
+            if target is not None:
+                target = os.path.join(base_path, target)
+                complete = queue_target(pending, target, deadline, max_pending) and complete
+
+    return complete
+
+def is_under(path, paths):
+    # True if path, or a directory above it, is in paths.
+    while path not in paths:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+    return True
+
+def watch(patterned_paths, matcher, quiet_period, max_pending, show_sources):
+    """
+    Watches base_path and removes paths covered by the delete rules while the
+    pipeline that writes them is still running. A file that itself is a rule
+    is removed when it is closed for writing; anything else (directories, and
+    files inside a deleted directory) is removed once there has been no
+    activity for quiet_period seconds. Runs until SIGINT or SIGTERM, then
+    does a final full pass, like a normal run would.
+    Returns the same (not_found, success) pair as remove().
+    """
+
+    watcher = InotifyWatcher()
+    pending = {}
+    # Everything already removed (or gone by the time it was due).
+    handled = set()
+    success = ''
+
+    stop_signals = []
+    def request_stop(signum, frame):
+        stop_signals.append(signum)
+    old_handlers = {}
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        old_handlers[signum] = signal.signal(signum, request_stop)
+
+    try:
+        # Anything that is already there waits out the quiet period too;
+        # it may still be being written.
+        deadline = time.monotonic() + quiet_period
+        rescan = not watch_tree(base_path, watcher, matcher, pending, deadline, max_pending)
+        next_sweep = deadline
+
+        while not stop_signals:
+            now = time.monotonic()
+            timeout = 1.0
+            if pending:
+                timeout = max(0.0, min(timeout, min(pending.values()) - now))
+
+            dropped = False
+            for path, mask in watcher.read_events(timeout):
+                if mask & IN_Q_OVERFLOW:
+                    # The kernel dropped events; only a re-scan can recover.
+                    dropped = True
+                    continue
+
+                now = time.monotonic()
+                if (mask & IN_ISDIR) and (mask & (IN_CREATE | IN_MOVED_TO)):
+                    if not watch_tree(path, watcher, matcher, pending,
+                                      now + quiet_period, max_pending):
+                        dropped = True
+                    continue
+
+                target = matcher.match(os.path.relpath(path, base_path))
+                if target is None:
+                    continue
+                target = os.path.join(base_path, target)
+
+                if (mask & IN_CLOSE_WRITE) and (target == path):
+                    deadline = 0
+                else:
+                    deadline = now + quiet_period
+                if not queue_target(pending, target, deadline, max_pending):
+                    dropped = True
+
+            # Backpressure: once the queue is full, new events are dropped
+            # and we re-scan the tree after the queue has drained by half.
+            rescan = rescan or dropped
+            if rescan and (len(pending) <= max_pending // 2):
+                rescan = not watch_tree(base_path, watcher, matcher, pending,
+                                        time.monotonic() + quiet_period, max_pending)
+
+            now = time.monotonic()
+            due = sorted(p for p, d in pending.items() if d <= now)
+            if due:
+                for p in due:
+                    del pending[p]
+                sources = None
+                if show_sources:
+                    sources = {}
+                    for p in due:
+                        rule = matcher.match_rule(os.path.relpath(p, base_path))[1]
+                        sources[p] = matcher.source(rule)
+                # Not-found here just means the pipeline cleaned up after
+                # itself, so only successes are kept.
+                _, removed = remove(due, sources)
+                success += removed
+                handled.update(due)
+
+            # Folders that could not be watched send no events, so they are
+            # re-scanned once per quiet period. This comes after the removal
+            # so that the re-scan never pushes back what it queued last time.
+            if watcher.unwatched and (time.monotonic() >= next_sweep):
+                watcher.unwatched = False
+                next_sweep = time.monotonic() + quiet_period
+                if not watch_tree(base_path, watcher, matcher, pending, next_sweep, max_pending):
+                    rescan = True
+
+    finally:
+        for signum, handler in old_handlers.items():
+            signal.signal(signum, handler)
+        watcher.close()
+
+    # Final full sweep catches everything still pending and anything that
+    # was never seen.
+    # Rules whose paths were removed above are not missing.
+    targets = make_targets(patterned_paths, matcher)
+    for p in list(targets):
+        if (not os.path.lexists(p)) and is_under(p, handled):
+            del targets[p]
+    sources = target_sources(targets, matcher) if show_sources else None
+    not_found, removed = remove(targets, sources)
+
+    return not_found, success + removed
+
+
+def read_paths(stream, separator):
+    # Yield the paths in a binary stream one at a time, reading it in chunks
+    # so that memory use does not depend on the length of the list.
+    leftover = b''
+    while True:
+        chunk = stream.read(65536)
+        if not chunk:
+            break
+        parts = (leftover + chunk).split(separator)
+        leftover = parts.pop()
+        for part in parts:
+            if part:
+                yield os.fsdecode(part)
+
+    if leftover:
+        yield os.fsdecode(leftover)
+
+def clean_path_stream(paths, matcher, separator, print_matches, show_sources):
+    """
+    Checks each path from an iterable against the compiled rules and removes
+    (or prints) the ones that match. Nothing is kept per path, so memory use
+    only depends on the number of rules.
+    A path inside a deleted directory stands for the directory. Listings
+    such as find's put a directory's contents right after it, so only the
+    last target is remembered to avoid handling the same one twice.
+    Successes go straight to the success record and paths that could not
+    be found straight to stderr.
+    """
+
+    abs_base = os.path.join(os.path.abspath(base_path), '')
+    last_target = None
+    any_not_found = False
+    success_file = None
+
+    if not print_matches:
+        success_file = open(os.path.join(base_path, 'custom_clean_success_record.txt'), 'w')
+
+    try:
+        for path in paths:
+            if os.path.isabs(path):
+                if not path.startswith(abs_base):
+                    continue
+                path = path[len(abs_base):]
+
+            rel_path = os.path.normpath(path)
+            if ('.' == rel_path) or ('..' == rel_path) or rel_path.startswith('../'):
+                continue
+
+            target, rule = matcher.match_rule(rel_path)
+            if (target is None) or (target == last_target):
+                continue
+            last_target = target
+
+            target = os.path.join(base_path, target)
+            if print_matches:
+                sys.stdout.buffer.write(os.fsencode(target) + separator)
+            else:
+                sources = None
+                if show_sources:
+                    sources = {target: matcher.source(rule)}
+                missing, removed = remove([target], sources)
+                if '\n' in missing:
+                    if not any_not_found:
+                        sys.stderr.write('Expected and could not find: ')
+                        any_not_found = True
+                    sys.stderr.write('\n' + target)
+                success_file.write(removed)
+
+    finally:
+        if success_file is not None:
+            success_file.close()
+        sys.stdout.flush()
+
+def archive_write_mode(archive_path):
+    # Stream mode for tarfile.open, from the output file's extension.
+    if archive_path.endswith(('.tar.gz', '.tgz')):
+        return 'w|gz'
+    if archive_path.endswith(('.tar.bz2', '.tbz2')):
+        return 'w|bz2'
+    if archive_path.endswith(('.tar.xz', '.txz')):
+        return 'w|xz'
+    return 'w|'
+
+def archive_rel_path(member_name, strip_components):
+    # Turn a member name into a path relative to the cleaned folder, or None
+    # if there is nothing left after stripping.
+    parts = [part for part in member_name.split('/') if part not in ('', '.')]
+    parts = parts[strip_components:]
+    if not parts:
+        return None
+    return '/'.join(parts)
+
+def archive_links_to_keep(in_path, matcher, strip_components):
+    """
+    First pass over an archive, for clean_archive. A hard link member has no
+    data of its own; it points at an earlier member. Returns a dict from each
+    dropped member that a kept hard link points at to the name of the first
+    such link. Only the headers are needed, and only those links are kept
+    in memory.
+    """
+    links = {}
+    with tarfile.open(in_path, 'r:*') as tar:
+        for member in tar:
+            if member.islnk() and (member.linkname not in links):
+                rel_path = archive_rel_path(member.name, strip_components)
+                target_path = archive_rel_path(member.linkname, strip_components)
+                if (((rel_path is None) or (matcher.match(rel_path) is None))
+                        and (target_path is not None) and (matcher.match(target_path) is not None)):
+                    links[member.linkname] = member.name
+            tar.members = []
+
+    return links
+
+def clean_archive(in_path, out_path, manifest_path, matcher, strip_components,
+                  show_sources=False):
+    """
+    Copies a tar archive member by member, leaving out the members that match
+    a delete rule (and everything under a deleted folder). Both archives are
+    opened in stream mode and member data goes straight from one to the
+    other, so memory use does not depend on the size of the archive.
+    Each member is kept or dropped by its own path. If a kept hard link
+    points at a dropped member, the data is written under the link's name
+    instead (see archive_links_to_keep), and later links to it point there.
+    The dropped members go to manifest_path, one per line: member name,
+    size and the rule that dropped it, separated by tabs, plus its rule set
+    if show_sources is set.
+    The output is written to a temp file and renamed into place when done.
+    Returns the number of members kept, dropped, and the bytes dropped.
+    """
+
+    kept = 0
+    dropped = 0
+    dropped_bytes = 0
+    links = archive_links_to_keep(in_path, matcher, strip_components)
+
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix='.' + os.path.basename(out_path) + '.',
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp, open(manifest_path, 'w') as manifest:
+            with tarfile.open(in_path, 'r|*') as tar_in, \
+                    tarfile.open(fileobj=tmp, mode=archive_write_mode(out_path)) as tar_out:
+                for member in tar_in:
+                    rule = None
+                    rel_path = archive_rel_path(member.name, strip_components)
+                    if rel_path is not None:
+                        rule = matcher.match_rule(rel_path)[1]
+
+                    if rule is not None:
+                        line = '%s\t%d\t%s' % (member.name, member.size, rule)
+                        if show_sources:
+                            line += '\t%s' % matcher.source(rule)
+                        manifest.write(line + '\n')
+                        dropped += 1
+                        if member.name in links:
+                            # A kept hard link needs this member; it goes in
+                            # here, under the link's name.
+                            moved = copy.copy(member)
+                            moved.name = links[member.name]
+                            if member.isreg():
+                                tar_out.addfile(moved, tar_in.extractfile(member))
+                            else:
+                                tar_out.addfile(moved)
+                        else:
+                            dropped_bytes += member.size
+                    elif member.islnk() and (member.linkname in links):
+                        first_link = links[member.linkname]
+                        if member.name != first_link:
+                            member.linkname = first_link
+                            tar_out.addfile(member)
+                        # The first link was written with the data above.
+                        kept += 1
+                    elif member.isreg():
+                        tar_out.addfile(member, tar_in.extractfile(member))
+                        kept += 1
+                    else:
+                        tar_out.addfile(member)
+                        kept += 1
+
+                    # TarFile keeps every TarInfo it has seen; we never need
+                    # them again.
+                    tar_in.members = []
+                    tar_out.members = []
+
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.rename(tmp_path, out_path)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    return kept, dropped, dropped_bytes
+
+def escape_path(path):
+    # Manifest columns are separated by tabs and rows by newlines.
+    return path.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+def unescape_path(text):
+    return re.sub(r'\\(.)', lambda m: {'t': '\t', 'n': '\n'}.get(m.group(1), m.group(1)), text)
+
+class ChecksumManifest(object):
+    """
+    Digests of the files that are kept, computed on a pool of threads while
+    the caller walks the folder. Digests from a previous manifest at the
+    same path are reused for files whose size and mtime have not changed.
+    The manifest has a header line naming the digest, then one line per
+    file: relative path, size, mtime (ns) and digest, separated by tabs.
+    """
+
+    def __init__(self, manifest_path, algorithm, jobs):
+        self.manifest_path = manifest_path
+        self.algorithm = algorithm
+        self.header = '# custom_clean checksum manifest: path\tsize\tmtime_ns\t%s\n' % algorithm
+        self.previous = self.read_previous()
+        self.entries = {}
+        self.jobs = jobs
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.pending = {}
+        self.max_pending = jobs * 8
+        self.hashed = 0
+        self.reused = 0
+        self.failures = 0
+
+    def read_previous(self):
+        previous = {}
+        try:
+            with open(self.manifest_path) as manifest:
+                # Digests made with another algorithm are no use.
+                if manifest.readline() != self.header:
+                    return previous
+                for line in manifest:
+                    path, size, mtime_ns, digest = line.rstrip('\n').split('\t')
+                    previous[unescape_path(path)] = (int(size), int(mtime_ns), digest)
+        except FileNotFoundError:
+            pass
+        except (IOError, ValueError):
+            sys.stderr.write('Could not read the old checksum manifest; hashing everything.\n')
+            previous = {}
+
+        return previous
+
+    def add(self, abs_path, rel_path):
+        # Only regular files are hashed; links and the like are skipped.
+        if (rel_path in self.entries) or any(rel_path == info[0] for info in self.pending.values()):
+            return
+        try:
+            st = os.lstat(abs_path)
+        except FileNotFoundError:
+            return
+        if not stat.S_ISREG(st.st_mode):
+            return
+
+        old = self.previous.get(rel_path)
+        if (old is not None) and (old[0] == st.st_size) and (old[1] == st.st_mtime_ns):
+            self.entries[rel_path] = old
+            self.reused += 1
+            return
+
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+        future = self.pool.submit(file_hash, abs_path, self.algorithm)
+        self.pending[future] = (rel_path, st.st_size, st.st_mtime_ns)
+
+        # Don't let the walk get too far ahead of the hashing.
+        if len(self.pending) >= self.max_pending:
+            self.collect(concurrent.futures.FIRST_COMPLETED)
+
+    def collect(self, return_when):
+        done, not_done = concurrent.futures.wait(self.pending, return_when=return_when)
+        for future in done:
+            rel_path, size, mtime_ns = self.pending.pop(future)
+            try:
+                self.entries[rel_path] = (size, mtime_ns, future.result())
+                self.hashed += 1
+            except OSError as err:
+                sys.stderr.write('Could not checksum %s.\n' % rel_path)
+                sys.stderr.write('OSError: %s.\n' % err)
+                self.failures += 1
+
+    def drain(self):
+        # Wait for the hashing and stop the threads, e.g. before forking
+        # worker processes. Files added later get a new pool.
+        if self.pending:
+            self.collect(concurrent.futures.ALL_COMPLETED)
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def close(self):
+        # Wait for the hashing, then write the manifest to a temp file and
+        # rename it into place.
+        self.drain()
+
+        out_dir = os.path.dirname(os.path.abspath(self.manifest_path))
+        fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.tmp',
+                                        prefix='.' + os.path.basename(self.manifest_path) + '.')
+        try:
+            with os.fdopen(fd, 'w') as manifest:
+                manifest.write(self.header)
+                for rel_path in sorted(self.entries):
+                    size, mtime_ns, digest = self.entries[rel_path]
+                    manifest.write('%s\t%d\t%d\t%s\n' % (escape_path(rel_path), size, mtime_ns, digest))
+            os.rename(tmp_path, self.manifest_path)
+        except BaseException:
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+def clean_and_checksum(matcher, manifest, compress_matcher, show_sources):
+    """
+    One walk of base_path that both removes what the rules match and hands
+    every kept file to manifest. Works like make_targets and remove()
+    together, but decides what to remove with matcher instead of globbing.
+    Files that will be compressed are left for the caller to add once they
+    are.
+    Returns the same (not_found, success) pair as remove().
+    """
+
+    not_found = 'Expected and could not find: '
+    success = ''
+    skip = set([os.path.abspath(manifest.manifest_path),
+                os.path.abspath(os.path.join(base_path, 'custom_clean_success_record.txt'))])
+    found = set()
+
+    for cur_path, dirs, files in os.walk(base_path):
+        rel_dir = os.path.relpath(cur_path, base_path)
+
+        for names, is_dir_list in ((dirs, True), (files, False)):
+            for name in list(names):
+                abs_path = os.path.join(cur_path, name)
+                if '.' == rel_dir:
+                    rel_path = name
+                else:
+                    rel_path = rel_dir + '/' + name
+
+                target, rule = matcher.match_rule(rel_path)
+                if target == rel_path:
+                    sources = None
+                    if show_sources:
+                        sources = {abs_path: matcher.source(rule)}
+                    removed = remove([abs_path], sources)[1]
+                    success += removed
+                    found.add(rel_path)
+                    if is_dir_list:
+                        # Nothing left to walk in there.
+                        names.remove(name)
+                elif (not is_dir_list) and (os.path.abspath(abs_path) not in skip):
+                    if (compress_matcher is None) or (compress_matcher.match(rel_path) is None):
+                        manifest.add(abs_path, rel_path)
+
+    # Plain rules that never came up, unless something above them went.
+    for rule in sorted(matcher.exact):
+        if (rule not in found) and (matcher.match(rule) == rule):
+            not_found += '\n' + os.path.join(base_path, rule)
+
+    return not_found, success
+
+# Sorted runs hold records of (key length, rule index, key).
+RUN_RECORD = struct.Struct('>II')
+# Most runs merged at once; more than this are merged in several passes.
+MAX_MERGE = 64
+
+def path_key(abs_path):
+    # Sort key for a path. With '/' as the lowest possible byte, a directory
+    # sorts right before everything inside it, and nothing else sorts in
+    # between.
+    return os.fsencode(abs_path).replace(b'/', b'\0')
+
+def key_path(key):
+    return os.fsdecode(key.replace(b'\0', b'/'))
+
+class SpillSorter(object):
+    """
+    External sort for (key, rule index) pairs. Pairs are kept in memory until
+    they take up about memory_cap bytes, then sorted and written to a run
+    file in spill_dir. Iterating merges the runs into one sorted stream.
+    """
+
+    def __init__(self, memory_cap, spill_dir=None):
+        self.memory_cap = memory_cap
+        self.spill_dir = spill_dir
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.runs = []
+
+    def add(self, key, rule_index):
+        self.buffer.append((key, rule_index))
+        # Rough size of the tuple, the bytes and the int.
+        self.buffered_bytes += len(key) + 120
+        if self.buffered_bytes >= self.memory_cap:
+            self.spill()
+
+    def spill(self):
+        self.buffer.sort()
+        self.runs.append(self.write_run(self.buffer))
+        self.buffer = []
+        self.buffered_bytes = 0
+
+    def write_run(self, records):
+        fd, run_path = tempfile.mkstemp(dir=self.spill_dir, prefix='custom_clean_run_')
+        with os.fdopen(fd, 'wb') as run:
+            for key, rule_index in records:
+                run.write(RUN_RECORD.pack(len(key), rule_index))
+                run.write(key)
+
+        return run_path
+
+    def read_run(self, run_path):
+        with open(run_path, 'rb', buffering=1024 * 1024) as run:
+            while True:
+                header = run.read(RUN_RECORD.size)
+                if not header:
+                    break
+                key_len, rule_index = RUN_RECORD.unpack(header)
+                yield run.read(key_len), rule_index
+
+    def __iter__(self):
+        if not self.runs:
+            self.buffer.sort()
+            return iter(self.buffer)
+
+        if self.buffer:
+            self.spill()
+
+        # Keep the number of open run files down.
+        while len(self.runs) > MAX_MERGE:
+            batch = self.runs[:MAX_MERGE]
+            merged = self.write_run(heapq.merge(*[self.read_run(r) for r in batch]))
+            for run_path in batch:
+                os.unlink(run_path)
+            self.runs = self.runs[MAX_MERGE:] + [merged]
+
+        return heapq.merge(*[self.read_run(r) for r in self.runs])
+
+    def close(self):
+        for run_path in self.runs:
+            if os.path.lexists(run_path):
+                os.unlink(run_path)
+        self.runs = []
+        self.buffer = []
+
+def clean_bounded(patterned_paths, matcher, memory_cap, spill_dir, show_sources):
+    """
+    Same result as make_targets and remove(), but memory use is capped: the
+    expanded targets go through a SpillSorter and are removed as the sorted
+    runs are merged. In that order a directory comes right before its
+    contents, so duplicates and paths inside a directory that is already
+    being removed are dropped by comparing with the last target. What is
+    left never nests, so every target can be removed as it comes (nothing
+    is removed before something inside it).
+    Successes go straight to the success record and paths that could not be
+    found straight to stderr.
+    """
+
+    rule_paths = list(patterned_paths)
+    sorter = SpillSorter(memory_cap, spill_dir)
+    any_not_found = False
+    last_key = None
+
+    try:
+        for abs_path, rule_index in iter_targets(rule_paths, matcher):
+            sorter.add(path_key(abs_path), rule_index)
+
+        with open(os.path.join(base_path, 'custom_clean_success_record.txt'), 'w') as success_file:
+            for key, rule_index in sorter:
+                if (last_key is not None) and ((key == last_key) or key.startswith(last_key + b'\0')):
+                    continue
+                last_key = key
+
+                target = key_path(key)
+                sources = None
+                if show_sources:
+                    sources = {target: matcher.source(rule_paths[rule_index])}
+                missing, removed = remove([target], sources)
+                if '\n' in missing:
+                    if not any_not_found:
+                        sys.stderr.write('Expected and could not find: ')
+                        any_not_found = True
+                    sys.stderr.write('\n' + target)
+                success_file.write(removed)
+    finally:
+        sorter.close()
+
+# Dead rules whose expansion had to look in more folders than this are not
+# remembered; checking them again would cost about as much as globbing.
+MAX_SIGNATURE = 1000
+# Folders a rule is remembered as dead in, most recently seen first, and the
+# number of runs a folder is remembered without being cleaned again.
+MAX_DEAD_FOLDERS = 32
+MAX_DEAD_AGE = 100
+
+def is_patterned(path):
+    # Same test make_paths uses.
+    return ('*' in path) or ('[0-9]' in path)
+
+def expansion_signature(rule):
+    """
+    The folders the expansion of a patterned rule has to look in, with their
+    mtimes, as a list of [relative path, mtime_ns]. Creating, removing or
+    renaming anything in a folder changes its mtime, so as long as these
+    are the same the rule still matches nothing. Returns None if the rule
+    does match something, or if the list would be longer than MAX_SIGNATURE.
+    """
+    signature = []
+    dirs = [base_path]
+
+    for part in rule.strip('/').split('/'):
+        part_regex = re.compile(rule_to_regex(part) + '\\Z') if is_patterned(part) else None
+        next_dirs = []
+        for dir_path in dirs:
+            try:
+                st = os.stat(dir_path)
+            except OSError:
+                continue
+            if not stat.S_ISDIR(st.st_mode):
+                continue
+            signature.append([os.path.relpath(dir_path, base_path), st.st_mtime_ns])
+            if len(signature) > MAX_SIGNATURE:
+                return None
+
+            if part_regex is None:
+                if os.path.lexists(os.path.join(dir_path, part)):
+                    next_dirs.append(os.path.join(dir_path, part))
+            else:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        if part_regex.match(entry.name) is not None:
+                            next_dirs.append(entry.path)
+        dirs = next_dirs
+
+    if dirs:
+        return None
+    return signature
+
+def signature_holds(signature):
+    for rel_path, mtime_ns in signature:
+        try:
+            if os.stat(os.path.join(base_path, rel_path)).st_mtime_ns != mtime_ns:
+                return False
+        except OSError:
+            return False
+
+    return True
+
+class RuleStats(object):
+    """
+    Hit counts and match times for every rule and pattern, kept across runs
+    in a JSON file. Rules are expanded and matched cheapest and most
+    selective first. A patterned rule that matched nothing is remembered as
+    dead in that folder together with its expansion_signature, and is not
+    expanded again until one of the folders in the signature changes. Only
+    the last MAX_DEAD_FOLDERS folders are remembered per rule, and none for
+    more than MAX_DEAD_AGE runs, so the file does not grow with the number
+    of folders cleaned.
+    """
+
+    def __init__(self, stats_path):
+        self.stats_path = stats_path
+        self.runs = 0
+        self.rules = {}
+        self.patterns = {}
+        # Rules that matched nothing this run; their signatures are taken in
+        # save(), after the cleaning has changed the folders.
+        self.dead_rules = []
+        # Pattern hits and time for this run, added in save().
+        self.run_patterns = {}
+
+        try:
+            with open(stats_path) as stats_file:
+                data = json.load(stats_file)
+            self.runs = data['runs']
+            self.rules = data['rules']
+            self.patterns = data['patterns']
+        except FileNotFoundError:
+            pass
+        except (IOError, ValueError, KeyError, TypeError):
+            sys.stderr.write('Could not read the rule stats in %s; starting over.\n' % stats_path)
+
+    def rule_entry(self, rule):
+        return self.rules.setdefault(rule, {'runs': 0, 'skipped': 0, 'hits': 0,
+                                            'cost': 0.0, 'dead_in': {}})
+
+    def order_key(self, rule):
+        # Average time per run, then fewest matches per run. Rules with no
+        # stats yet go first.
+        entry = self.rules.get(rule)
+        if (entry is None) or (not entry['runs']):
+            return (0.0, 0.0)
+        return (entry['cost'] / entry['runs'], entry['hits'] / entry['runs'])
+
+    def is_dead(self, rule):
+        # Plain rules are never skipped; they cost one lstat anyway.
+        entry = self.rules.get(rule)
+        if (entry is None) or (not is_patterned(rule)):
+            return False
+        dead = entry['dead_in'].get(os.path.abspath(base_path))
+        if (dead is None) or not signature_holds(dead['signature']):
+            return False
+        dead['run'] = self.runs
+        return True
+
+    def record_skip(self, rule):
+        self.rule_entry(rule)['skipped'] += 1
+
+    def record_rule(self, rule, hits, cost):
+        entry = self.rule_entry(rule)
+        entry['runs'] += 1
+        entry['hits'] += hits
+        entry['cost'] += cost
+
+        entry['dead_in'].pop(os.path.abspath(base_path), None)
+        if (not hits) and is_patterned(rule):
+            self.dead_rules.append(rule)
+
+    def record_pattern(self, pattern, hits, cost):
+        # apply_patterns runs more than once per run; this run's totals are
+        # only counted in save().
+        totals = self.run_patterns.setdefault(pattern, [0, 0.0])
+        totals[0] += hits
+        totals[1] += cost
+
+    def save(self):
+        # Counts this run, then writes to a temp file and renames it into place.
+        for pattern, (hits, cost) in self.run_patterns.items():
+            entry = self.patterns.setdefault(pattern, {'runs': 0, 'hits': 0, 'cost': 0.0})
+            entry['runs'] += 1
+            entry['hits'] += hits
+            entry['cost'] += cost
+        self.run_patterns = {}
+
+        dir_key = os.path.abspath(base_path)
+        for rule in self.dead_rules:
+            signature = expansion_signature(rule)
+            if signature is not None:
+                self.rules[rule]['dead_in'][dir_key] = {'run': self.runs, 'signature': signature}
+        self.dead_rules = []
+
+        for entry in self.rules.values():
+            dead_in = entry['dead_in']
+            for dir_path in [d for d in dead_in if self.runs - dead_in[d]['run'] >= MAX_DEAD_AGE]:
+                del dead_in[dir_path]
+            if len(dead_in) > MAX_DEAD_FOLDERS:
+                newest = sorted(dead_in, key=lambda d: dead_in[d]['run'])[-MAX_DEAD_FOLDERS:]
+                entry['dead_in'] = dict((d, dead_in[d]) for d in newest)
+        self.runs += 1
+
+        out_dir = os.path.dirname(os.path.abspath(self.stats_path))
+        fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.tmp',
+                                        prefix='.' + os.path.basename(self.stats_path) + '.')
+        try:
+            with os.fdopen(fd, 'w') as stats_file:
+                json.dump({'runs': self.runs, 'rules': self.rules, 'patterns': self.patterns},
+                          stats_file, indent=1, sort_keys=True)
+            os.rename(tmp_path, self.stats_path)
+        except BaseException:
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def report(self, patterned_paths, matcher):
+        """
+        Text listing the rules that never matched anything, the patterns
+        that never changed a rule, rules inside a folder another rule already
+        removes, and the slowest rules.
+        """
+        lines = ['Rule stats from %d runs (%s)' % (self.runs, self.stats_path)]
+
+        def rule_name(rule):
+            if len(set(matcher.sources.values())) > 1:
+                return '%s (rule set: %s)' % (rule, matcher.source(rule))
+            return rule
+
+        dead = []
+        for rule in sorted(patterned_paths):
+            entry = self.rules.get(rule)
+            if (entry is not None) and (entry['runs'] or entry['skipped']) and (not entry['hits']):
+                dead.append('    %s: tried %d times, skipped %d times' % (
+                        rule_name(rule), entry['runs'], entry['skipped']))
+        lines.append('Rules that never matched anything: %d' % len(dead))
+        lines.extend(dead)
+
+        unused = []
+        for pattern in sorted(self.patterns):
+            entry = self.patterns[pattern]
+            if entry['runs'] and not entry['hits']:
+                unused.append('    %s' % pattern)
+        lines.append('Patterns that never changed a rule: %d' % len(unused))
+        lines.extend(unused)
+
+        # A rule below another rule only matters if something in between is kept.
+        redundant = []
+        rule_set = set(patterned_paths)
+        for rule in sorted(patterned_paths):
+            parts = rule.strip('/').split('/')
+            for i in range(1, len(parts)):
+                prefix = '/'.join(parts[:i])
+                above = prefix if prefix in rule_set else matcher.rule_for(prefix)
+                if above is None:
+                    continue
+                if matcher.has_keeps and matcher.holds_kept(prefix):
+                    break
+                redundant.append('    %s: inside %s' % (rule_name(rule), rule_name(above)))
+                break
+        lines.append('Rules already covered by a folder rule: %d' % len(redundant))
+        lines.extend(redundant)
+
+        timed = [(entry['cost'] / entry['runs'], rule) for rule, entry in self.rules.items()
+                 if entry['runs'] and (rule in rule_set)]
+        timed.sort(reverse=True)
+        lines.append('Slowest rules (average seconds per run):')
+        for cost, rule in timed[:10]:
+            lines.append('    %.6f  %s' % (cost, rule_name(rule)))
+
+        return '\n'.join(lines) + '\n'
+
+def load_cleaning_json(json_path):
+    # Returns the file system data (as a dict of rule_tree.RuleNodes) and the
+    # pattern list from a cleaning JSON.
+    try:
+        with open(json_path) as j:
+            whole_json_data = rule_tree.load(j)
             pattern_list = whole_json_data['pattern_list']
             json_data = whole_json_data['file_system_data']
-    except IOError:
+    except (IOError, ValueError, KeyError):
         sys.stderr.write('The specified cleaning JSON could not be read.')
-        sys.exit(code=5)
+        sys.exit(5)
+
+    return json_data, pattern_list
+
+def compile_rule_sets(json_paths, extra_pattern, precedence, stats=None):
+    """
+    Reads one or more cleaning JSONs and merges them into one set of rules.
+    The pattern lists (and the -p pattern) are merged and applied to every
+    JSON. Returns the patterned delete rules in an order they can be removed
+    in, a RuleMatcher for them that knows which JSON each rule came from,
+    the compress rules, and the JSON's size for each file to delete (if it
+    has one).
+    With stats (a RuleStats), the matcher tries the rules in stats order and
+    pattern hits are recorded.
+    """
 
-    base_path = args.dir
+    rule_sets = []
+    pattern_list = []
+    for json_path in json_paths:
+        json_data, set_patterns = load_cleaning_json(json_path)
+        rule_sets.append((json_path, json_data))
+        for pattern in set_patterns:
+            if pattern not in pattern_list:
+                pattern_list.append(pattern)
+
+    if extra_pattern and (extra_pattern not in pattern_list):
+        pattern_list.append(extra_pattern)
+
+    # The first JSON that deletes a path gets the credit for it.
+    sources = {}
+    dir_rules = set()
+    keep_paths = []
+    compress_paths = []
+    size_hints = {}
+    for json_path, json_data in rule_sets:
+        set_files = []
+        set_dirs = []
+        get_files_to_delete(json_data, set_files)
+        get_dirs_to_delete(json_data, set_dirs)
+        set_dirs = apply_patterns(set_dirs, pattern_list, stats)
+        set_paths = apply_patterns(set_files, pattern_list, stats) + set_dirs
+        dir_rules.update(set_dirs)
+        for path in set_paths:
+            sources.setdefault(path, json_path)
+
+        if 'keep' == precedence:
+            # A JSON's own keep rules inside folders it deletes mean nothing.
+            set_matcher = RuleMatcher(set_paths)
+            set_keeps = []
+            get_paths_with_state(json_data, rule_tree.KEEP, set_keeps)
+            for path in apply_patterns(set_keeps, pattern_list):
+                if set_matcher.match(path) is None:
+                    keep_paths.append(path)
+
+        get_paths_with_state(json_data, rule_tree.COMPRESS, compress_paths)
+        get_size_hints(json_data, size_hints)
+
+    # Files first, then dirs bottom up over all the JSONs, so that nothing
+    # is removed before something inside it.
+    patterned_paths = [p for p in sources if p not in dir_rules]
+    patterned_paths += sorted((p for p in sources if p in dir_rules),
+                              key=lambda p: -p.strip('/').count('/'))
+
+    matcher_paths = patterned_paths
+    if stats is not None:
+        # The matcher tries its patterned rules in stats order.
+        matcher_paths = sorted(patterned_paths, key=stats.order_key)
+    matcher = RuleMatcher(matcher_paths, keep_paths, sources)
+    compress_paths = apply_patterns(compress_paths, pattern_list)
+
+    return patterned_paths, matcher, compress_paths, size_hints
+
+def set_base_path(dir_path):
+    global base_path
+
+    base_path = dir_path
     if not base_path.endswith('/'):
         base_path = base_path + '/'
 
-    if args.pattern:
-        pattern_list.append(args.pattern)
+def write_success_record(success_msg, dir_path=None, append=False):
+    # Save success output to file at the top level of the cleaned folder.
+    if dir_path is None:
+        dir_path = base_path
+    with open(os.path.join(dir_path, 'custom_clean_success_record.txt'),
+              'a' if append else 'w') as success_file:
+        success_file.write(success_msg)
+
+
+
+def file_hash(path, algorithm='sha256'):
+    # Hex digest of a file's contents, read in chunks.
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+class RuleCache(object):
+    """
+    LRU cache of compile_rule_sets results. The key holds each JSON's path
+    and a hash of its contents, so editing a JSON makes a new entry.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, json_paths, extra_pattern, precedence):
+        try:
+            key = (tuple((p, file_hash(p)) for p in json_paths), extra_pattern, precedence)
+        except IOError:
+            sys.stderr.write('The specified cleaning JSON could not be read.')
+            sys.exit(5)
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        # Two clients may compile the same rules at once; that is harmless.
+        compiled = compile_rule_sets(json_paths, extra_pattern, precedence)
+
+        with self.lock:
+            self.entries[key] = compiled
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+        return compiled
+
+class CleaningRequestHandler(socketserver.StreamRequestHandler):
+    """
+    One request per connection: a line of JSON in, a line of JSON out.
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode())
+            response = self.server.dispatch(request)
+        except SystemExit as err:
+            # The cleaning functions exit on errors; the details went to
+            # the daemon's stderr.
+            response = {'ok': False, 'code': err.code,
+                        'error': 'Request failed with code %s; see the daemon log.' % err.code}
+        except (ValueError, KeyError, TypeError, OSError) as err:
+            response = {'ok': False, 'code': 1, 'error': 'Bad request: %s' % err}
+
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+class CleaningDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Cleans folders for clients connecting to a Unix socket, without
+    re-reading and re-compiling the cleaning JSONs every time.
+    Requests are {"op": "clean" | "plan" | "status", "json": [...],
+    "dir": ..., "pattern": ..., "precedence": ...}.
+    Planning uses the module-level base_path, so it is done one request at
+    a time; at most max_deletes requests remove files at the same time.
+    All requests compress on one pool of jobs processes. Its workers are
+    spawned, not forked, since forking a process with several threads can
+    leave locks held in the child.
+    """
+
+    daemon_threads = True
 
-    # Get files to be deleted.
-    get_files_to_delete(json_data) # data now in global list files_to_delete[]
+    def __init__(self, socket_path, cache_size, max_deletes, jobs):
+        # Only our own user may connect.
+        old_umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, CleaningRequestHandler)
+        finally:
+            os.umask(old_umask)
 
-    # Get dirs to be deleted.
-    # Note: we get the dirs top down, but want to process bottom up.
-    #       (we want to delete subdirs before we delete parent dirs).
-    #       Thus the 'reverse'.
-    get_dirs_to_delete(json_data) # data is now in global list dirs_to_delete[]
-    dirs_to_delete.reverse()
+        self.rule_cache = RuleCache(cache_size)
+        self.compress_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, mp_context=multiprocessing.get_context('spawn'))
+        self.max_deletes = max_deletes
+        self.delete_slots = threading.BoundedSemaphore(max_deletes)
+        self.plan_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.started = time.time()
+        self.served = 0
+        self.deleting = 0
 
-    # Must process files before dirs, so add dirs to the end of the list.
-    paths_to_delete = files_to_delete
-    paths_to_delete.extend(dirs_to_delete)
+    def dispatch(self, request):
+        op = request.get('op')
+        if 'status' == op:
+            return self.status()
+        if op not in ('clean', 'plan'):
+            raise ValueError('unknown op %r' % op)
+
+        json_paths = request['json']
+        dir_path = request['dir']
+        patterned_paths, matcher, compress_paths, size_hints = self.rule_cache.get(
+                json_paths, request.get('pattern'), request.get('precedence', 'delete'))
+
+        with self.plan_lock:
+            set_base_path(dir_path)
+            targets = make_targets(patterned_paths, matcher)
+            sources = target_sources(targets, matcher) if len(json_paths) > 1 else None
+            compress_targets = make_paths(compress_paths) if compress_paths else set()
+
+        with self.stats_lock:
+            self.served += 1
+
+        if 'plan' == op:
+            return {'ok': True, 'code': 0, 'targets': sorted(targets),
+                    'compress': sorted(compress_targets)}
+
+        with self.delete_slots:
+            with self.stats_lock:
+                self.deleting += 1
+            try:
+                not_found_msg, success_msg = remove(targets, sources)
+                failures = 0
+                if compress_targets:
+                    missing, compressed, failures = compress(compress_targets,
+                                                             request.get('compress_format', 'gzip'),
+                                                             None, self.compress_pool)
+                    not_found_msg += missing
+                    success_msg += compressed
+            finally:
+                with self.stats_lock:
+                    self.deleting -= 1
 
-    patterned_paths = apply_patterns(paths_to_delete, pattern_list)
+        write_success_record(success_msg, dir_path)
 
-    # Use OS to get absolute paths and to expand patterned paths.
-    target_paths = make_paths(patterned_paths)
+        return {'ok': not failures, 'code': 1 if failures else 0, 'not_found': not_found_msg}
+
+    def status(self):
+        with self.stats_lock, self.rule_cache.lock:
+            return {'ok': True, 'code': 0,
+                    'uptime': time.time() - self.started,
+                    'served': self.served,
+                    'deleting': self.deleting,
+                    'max_deletes': self.max_deletes,
+                    'cached_rule_sets': len(self.rule_cache.entries),
+                    'cache_hits': self.rule_cache.hits,
+                    'cache_misses': self.rule_cache.misses}
+
+def serve(socket_path, cache_size, max_deletes, jobs):
+    # Runs the daemon until SIGINT or SIGTERM.
+    if os.path.lexists(socket_path):
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            sys.stderr.write('%s exists and is not a socket.' % socket_path)
+            sys.exit(1)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            sys.stderr.write('A daemon is already listening on %s.' % socket_path)
+            sys.exit(1)
+        except ConnectionRefusedError:
+            # Left over from a daemon that did not shut down cleanly.
+            os.unlink(socket_path)
+        finally:
+            probe.close()
+
+    server = CleaningDaemon(socket_path, cache_size, max_deletes, jobs)
+
+    def request_stop(signum, frame):
+        # shutdown() waits for serve_forever(), so it cannot run in this thread.
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.compress_pool.shutdown()
+        os.unlink(socket_path)
+
+def send_request(socket_path, request):
+    # Thin client: one line of JSON to the daemon, one line back.
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode() + b'\n')
+        with client.makefile('rb') as response:
+            return json.loads(response.readline().decode())
+    finally:
+        client.close()
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
 
-    # Delete/remove/unlink all specified files/directories/links
-    not_found_msg, success_msg = remove(target_paths)
+    if args.serve:
+        serve(args.serve, args.cache_size, args.max_deletes, args.jobs)
+        return
+
+    if args.status:
+        if not args.connect:
+            parser.error('--status only works with --connect.')
+        response = send_request(args.connect, {'op': 'status'})
+        print(json.dumps(response, indent=4, sort_keys=True))
+        return
+
+    if not args.json:
+        parser.error('the following arguments are required: -j/--json')
+
+    if args.connect:
+        if (args.watch or args.paths_from or args.archive or (args.free_target is not None)
+                or args.checksum_manifest or args.rule_stats):
+            parser.error('--connect only does normal cleaning runs (and --plan).')
+        if not args.dir:
+            parser.error('the following arguments are required: -d/--dir')
+        # The daemon has its own working directory.
+        request = {'op': 'plan' if args.plan else 'clean',
+                   'json': [os.path.abspath(p) for p in args.json],
+                   'dir': os.path.abspath(args.dir),
+                   'pattern': args.pattern,
+                   'precedence': args.precedence,
+                   'compress_format': args.compress_format}
+        response = send_request(args.connect, request)
+        if 'error' in response:
+            sys.stderr.write(response['error'])
+        elif args.plan:
+            for p in response['targets']:
+                print(p)
+        elif '\n' in response['not_found']:
+            sys.stderr.write(response['not_found'])
+        if response['code']:
+            sys.exit(response['code'])
+        return
+    if args.plan:
+        parser.error('--plan only works with --connect.')
+
+    if args.watch and not sys.platform.startswith('linux'):
+        parser.error('--watch needs Linux inotify.')
+    if args.watch and args.paths_from:
+        parser.error('--watch and --paths-from cannot be used together.')
+    if args.print_matches and not args.paths_from:
+        parser.error('--print-matches only works with --paths-from.')
+    if args.archive:
+        if not args.archive_out:
+            parser.error('--archive needs --archive-out.')
+        if args.watch or args.paths_from:
+            parser.error('--archive cannot be used with --watch or --paths-from.')
+    elif not (args.dir or args.rule_report):
+        parser.error('the following arguments are required: -d/--dir')
+    if args.rule_report and not args.rule_stats:
+        parser.error('--rule-report needs --rule-stats.')
+    if args.rule_stats and (args.watch or args.paths_from or args.archive or args.checksum_manifest
+                            or (args.memory_cap is not None)):
+        parser.error('--rule-stats only works with normal cleaning runs.')
+    if (args.free_target is not None) and (args.watch or args.paths_from or args.archive):
+        parser.error('--free-target cannot be used with --watch, --paths-from or --archive.')
+    if args.checksum_manifest and (args.watch or args.paths_from or args.archive or args.connect
+                                   or (args.free_target is not None)):
+        parser.error('--checksum-manifest only works with normal cleaning runs.')
+    if (args.memory_cap is not None) and (args.watch or args.paths_from or args.archive
+                                          or args.connect or args.checksum_manifest
+                                          or (args.free_target is not None)):
+        parser.error('--memory-cap only works with normal cleaning runs.')
+
+    # Arguments are paths to JSONs, and, optionally, a single pattern.
+    # JSON data may contain patterns as well. If the user supplies a pattern,
+    # it will be added to the list.
+    stats = RuleStats(args.rule_stats) if args.rule_stats else None
+    patterned_paths, matcher, compress_paths, size_hints = compile_rule_sets(
+            args.json, args.pattern, args.precedence, stats)
+
+    if args.rule_report and not (args.dir or args.archive):
+        # Only the report was asked for.
+        sys.stdout.write(stats.report(patterned_paths, matcher))
+        return
+
+    # The success record says which JSON removed what, if there is a choice.
+    show_sources = len(args.json) > 1
+
+    if args.archive:
+        manifest_path = args.archive_manifest or (args.archive_out + '.dropped.txt')
+        try:
+            clean_archive(args.archive, args.archive_out, manifest_path,
+                          matcher, args.strip_components, show_sources)
+        except (IOError, tarfile.TarError) as err:
+            sys.stderr.write('The archive could not be cleaned.')
+            sys.stderr.write('Error: %s.' % err)
+            sys.exit(1)
+        return
+
+    set_base_path(args.dir)
+
+    if args.paths_from:
+        # The list is read as it streams in; the folder is never listed.
+        separator = b'\0' if args.null else b'\n'
+        if '-' == args.paths_from:
+            clean_path_stream(read_paths(sys.stdin.buffer, separator),
+                              matcher, separator, args.print_matches, show_sources)
+        else:
+            with open(args.paths_from, 'rb') as path_list:
+                clean_path_stream(read_paths(path_list, separator),
+                                  matcher, separator, args.print_matches, show_sources)
+        return
+
+    record_written = False
+    if args.memory_cap is not None:
+        clean_bounded(patterned_paths, matcher, args.memory_cap, args.spill_dir, show_sources)
+        record_written = True
+        not_found_msg = ''
+        success_msg = ''
+    elif args.watch:
+        not_found_msg, success_msg = watch(patterned_paths, matcher, args.quiet_period,
+                                           args.max_pending, show_sources)
+    elif args.checksum_manifest:
+        # The folder has to be walked for the checksums anyway, so the walk
+        # finds the targets too.
+        manifest = ChecksumManifest(args.checksum_manifest, args.checksum_algorithm, args.jobs)
+        compress_matcher = RuleMatcher(compress_paths) if compress_paths else None
+        not_found_msg, success_msg = clean_and_checksum(matcher, manifest, compress_matcher,
+                                                        show_sources)
+    else:
+        # Use OS to get absolute paths and to expand patterned paths.
+        targets = make_targets(patterned_paths, matcher, stats)
+
+        # Delete/remove/unlink all specified files/directories/links
+        sources = target_sources(targets, matcher) if show_sources else None
+        if args.free_target is None:
+            not_found_msg, success_msg = remove(targets, sources)
+        else:
+            # A path inside another target goes with it; counting it on
+            # its own would count it twice.
+            targets = drop_nested(targets)
+            sizes = estimate_sizes(targets, size_hints, args.jobs)
+            not_found_msg, success_msg = free_space(targets, sizes, args.free_target, sources)
+
+    # Files that were not deleted and have state 'compress' get compressed.
+    failures = 0
+    if compress_paths and (args.free_target is None):
+        target_paths = make_paths(compress_paths)
+        if args.checksum_manifest:
+            # The compress workers are forked; no hashing threads may be
+            # running then.
+            manifest.drain()
+        missing, compressed, failures = compress(target_paths, args.compress_format, args.jobs)
+        not_found_msg += missing
+        success_msg += compressed
+
+    if args.checksum_manifest:
+        # Compressed files are only checksummed once they are done.
+        if compress_paths:
+            for p in make_paths(compress_paths):
+                if os.path.isdir(p) and not os.path.islink(p):
+                    for cur_path, dirs, files in os.walk(p):
+                        for filename in files:
+                            abs_path = os.path.join(cur_path, filename)
+                            manifest.add(abs_path, os.path.relpath(abs_path, base_path))
+                else:
+                    for q in (p,) + tuple(p + ext for ext, opener in COMPRESSORS.values()):
+                        if os.path.isfile(q):
+                            manifest.add(q, os.path.relpath(q, base_path))
+        manifest.close()
+        success_msg += 'Checksummed %d files (%d unchanged, digest reused) into %s\n' % (
+                manifest.hashed + manifest.reused, manifest.reused, args.checksum_manifest)
+        failures += manifest.failures
 
     # Send output about files not found to stderr if applicable
     if '\n' in not_found_msg:
         sys.stderr.write(not_found_msg)
 
-    # Save success output to file
-    os.chdir(base_path)
-    success_file = open('custom_clean_success_record.txt', 'w')
-    success_file.write(success_msg)
+    write_success_record(success_msg, append=record_written)
+
+    if stats is not None:
+        stats.save()
+        if args.rule_report:
+            sys.stdout.write(stats.report(patterned_paths, matcher))
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
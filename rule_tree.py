@@ -0,0 +1,235 @@
+#! /usr/bin/env python3
+
+# ------------------------------------------------------------------------
+# CustomClean Rule Tree
+#
+# Compact in-memory form of the "file_system_data" part of a cleaning JSON,
+# shared by the cleaning script and the GUI.
+#
+# Each file or folder is one RuleNode with __slots__ instead of a dict. Names
+# are interned, the state is a small int, and rel_path is rebuilt from the
+# parent chain when asked for instead of being stored on every node. It
+# converts to and from the JSON schema without losing anything.
+#
+# Run this file with a cleaning JSON (or with no arguments, for a made-up
+# tree) to compare its memory footprint with the plain dict tree.
+
+import sys
+import os
+import json
+import argparse
+import tracemalloc
+
+KEEP = 0
+DELETE = 1
+COMPRESS = 2
+STATE_NAMES = ('keep', 'delete', 'compress')
+
+# Keys every node has in the JSON; anything else goes in RuleNode.extra.
+NODE_KEYS = ('name', 'type', 'state', 'rel_path', 'size', 'children')
+
+
+def join_rel(parent_rel, name):
+    # Same relative paths the GUI writes: children of '.' have no prefix.
+    if '.' == parent_rel:
+        return name
+    return parent_rel + os.sep + name
+
+def state_code(state_name):
+    try:
+        return STATE_NAMES.index(state_name)
+    except ValueError:
+        raise ValueError('Unknown state in cleaning JSON: %s' % state_name)
+
+
+class RuleNode(object):
+    """
+    One file or folder in the rule tree. Folders have a dict of children
+    (keyed by name, like the JSON); files have children set to None.
+    rel is only set when rel_path cannot be rebuilt from the parent, which
+    is normally just the top-level nodes. size is None if the JSON had none.
+    """
+
+    __slots__ = ('name', 'state', 'size', 'children', 'parent', 'rel', 'extra')
+
+    def __init__(self, name, state=KEEP, size=0, children=None, rel=None, extra=None):
+        self.name = sys.intern(name)
+        self.state = state
+        self.size = size
+        self.children = children
+        self.parent = None
+        self.rel = rel
+        self.extra = extra
+
+        if children:
+            for child in children.values():
+                self.adopt(child)
+
+    def is_dir(self):
+        return self.children is not None
+
+    def rel_path(self):
+        if self.rel is not None:
+            return self.rel
+        return join_rel(self.parent.rel_path(), self.name)
+
+    def adopt(self, child):
+        # Drop the child's stored rel_path if it can be rebuilt from ours.
+        child.parent = self
+        if (child.rel is not None) and (child.rel == join_rel(self.rel_path(), child.name)):
+            child.rel = None
+
+    def add_child(self, child, key=None):
+        if key is None:
+            key = child.name
+        self.children[key] = child
+        self.adopt(child)
+
+    def to_dict(self):
+        d = {}
+        d['name'] = self.name
+        d['type'] = 'folder' if self.is_dir() else 'file'
+        d['state'] = STATE_NAMES[self.state]
+        d['rel_path'] = self.rel_path()
+        if self.size is not None:
+            d['size'] = self.size
+        if self.is_dir():
+            d['children'] = to_json(self.children)
+        if self.extra:
+            d.update(self.extra)
+
+        return d
+
+
+def node_from_dict(d):
+    """
+    Turns one node dict from the JSON into a RuleNode. Children must already
+    be RuleNodes. Dicts that are not nodes are returned unchanged, so this
+    can be used as a json object_hook.
+    """
+    if not (isinstance(d.get('type'), str) and ('state' in d) and ('name' in d)):
+        return d
+
+    extra = None
+    for key in d:
+        if key not in NODE_KEYS:
+            if extra is None:
+                extra = {}
+            extra[key] = d[key]
+
+    children = None
+    if 'folder' == d['type']:
+        children = d.get('children', {})
+    elif 'file' != d['type']:
+        # Not a type we know; keep it as-is and treat the node as a file.
+        if extra is None:
+            extra = {}
+        extra['type'] = d['type']
+
+    return RuleNode(d['name'], state_code(d['state']), d.get('size'),
+                    children, d['rel_path'], extra)
+
+def from_json(file_system_data):
+    # Converts already parsed file_system_data (a dict of dicts) to RuleNodes.
+    roots = {}
+    for key, val in file_system_data.items():
+        if 'children' in val:
+            val = dict(val)
+            val['children'] = from_json(val['children'])
+        roots[key] = node_from_dict(val)
+
+    return roots
+
+def to_json(nodes):
+    # Converts a dict of RuleNodes back to the JSON schema.
+    d = {}
+    for key, node in nodes.items():
+        d[key] = node.to_dict()
+
+    return d
+
+def load(fp):
+    """
+    Reads a whole cleaning JSON. The file_system_data in the result is a dict
+    of RuleNodes; they are built while parsing, so the dict tree never exists
+    in full.
+    """
+    return json.load(fp, object_hook=node_from_dict)
+
+def walk(nodes):
+    # Yields every node, parents before children, in JSON order.
+    for node in nodes.values():
+        yield node
+        if node.is_dir():
+            for child in walk(node.children):
+                yield child
+
+
+def make_test_data(num_subjects):
+    # Made-up file_system_data shaped like an HCP study folder.
+    study = {'name': 'study', 'type': 'folder', 'state': 'keep', 'rel_path': '.',
+             'size': 0, 'children': {}}
+    for s in range(num_subjects):
+        sub_name = 'sub-%04d' % s
+        sub = {'name': sub_name, 'type': 'folder', 'state': 'keep', 'rel_path': sub_name,
+               'size': 0, 'children': {}}
+        study['children'][sub_name] = sub
+        for run in range(1, 5):
+            run_name = 'task-rest_run-%02d' % run
+            run_rel = os.path.join(sub_name, 'MNINonLinear', 'Results', run_name)
+            run_dir = {'name': run_name, 'type': 'folder', 'state': 'keep',
+                       'rel_path': run_rel, 'size': 0, 'children': {}}
+            sub['children'][run_name] = run_dir
+            for f in range(25):
+                file_name = '%s_file%02d.nii.gz' % (run_name, f)
+                run_dir['children'][file_name] = {
+                        'name': file_name, 'type': 'file',
+                        'state': 'delete' if f % 3 else 'keep',
+                        'rel_path': os.path.join(run_rel, file_name), 'size': 1024 * f}
+
+    return {'pattern_list': [], 'file_system_data': {'study': study}}
+
+def measure(load_fn):
+    # Memory still held by whatever load_fn returns, and the peak while loading.
+    tracemalloc.start()
+    result = load_fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return current, peak
+
+def benchmark(json_text):
+    dict_current, dict_peak = measure(lambda: json.loads(json_text))
+    tree_current, tree_peak = measure(lambda: json.loads(json_text, object_hook=node_from_dict))
+
+    num_nodes = sum(1 for node in walk(from_json(json.loads(json_text)['file_system_data'])))
+    print('Nodes: %d' % num_nodes)
+    print('%-10s %15s %15s' % ('', 'held (bytes)', 'peak (bytes)'))
+    print('%-10s %15d %15d' % ('dict tree', dict_current, dict_peak))
+    print('%-10s %15d %15d' % ('RuleNode', tree_current, tree_peak))
+    print('RuleNode holds %.1f%% of the dict tree.' % (100.0 * tree_current / dict_current))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the memory used by the dict '
+                                     'tree and the RuleNode tree for a cleaning JSON.')
+    parser.add_argument('json', nargs='?', help='Cleaning JSON. Default: a made-up study.')
+    parser.add_argument('--subjects', type=int, default=200,
+                        help='Number of subjects in the made-up study. Default: %(default)s.')
+    args = parser.parse_args()
+
+    if args.json:
+        with open(args.json) as j:
+            json_text = j.read()
+    else:
+        json_text = json.dumps(make_test_data(args.subjects))
+
+    # Make sure the round trip is exact before comparing anything.
+    whole_json_data = json.loads(json_text)
+    roots = from_json(whole_json_data['file_system_data'])
+    if to_json(roots) != whole_json_data['file_system_data']:
+        sys.stderr.write('RuleNode round trip does not match the JSON.\n')
+        sys.exit(1)
+
+    benchmark(json_text)
@@ -0,0 +1,601 @@
+import os
+import sys
+import errno
+import ctypes
+import threading
+import re
+import gzip
+import json
+import hashlib
+import tarfile
+import signal
+import subprocess
+import time
+
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'cleaning_script.py')
+RECORD = 'custom_clean_success_record.txt'
+
+sys.path.insert(0, os.path.dirname(SCRIPT))
+
+import cleaning_script
+
+
+def make_tree(root, files):
+    # files: relative path -> contents. Paths ending in '/' are empty folders.
+    for rel_path, contents in files.items():
+        path = os.path.join(str(root), rel_path)
+        if rel_path.endswith('/'):
+            os.makedirs(path, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(contents)
+
+def make_json(path, states, pattern_list=(), sizes=None):
+    """
+    Writes a cleaning JSON. states maps relative paths to 'delete', 'keep'
+    or 'compress'; paths ending in '/' are folders. Folders above them are
+    added with state 'keep'.
+    """
+    sizes = sizes or {}
+    roots = {}
+
+    def node(children, rel_path, is_folder):
+        name = rel_path.rsplit('/', 1)[-1]
+        if name not in children:
+            children[name] = {'name': name, 'type': 'folder' if is_folder else 'file',
+                              'state': 'keep', 'rel_path': rel_path,
+                              'size': sizes.get(rel_path, 0)}
+            if is_folder:
+                children[name]['children'] = {}
+        return children[name]
+
+    for rel_path, state in states.items():
+        is_folder = rel_path.endswith('/')
+        parts = rel_path.strip('/').split('/')
+        children = roots
+        for i in range(1, len(parts)):
+            children = node(children, '/'.join(parts[:i]), True)['children']
+        node(children, '/'.join(parts), is_folder)['state'] = state
+
+    with open(str(path), 'w') as f:
+        json.dump({'pattern_list': list(pattern_list), 'file_system_data': roots}, f)
+
+    return str(path)
+
+def run_clean(*args, **kwargs):
+    cmd = [sys.executable, SCRIPT] + [str(a) for a in args]
+    return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, timeout=60, **kwargs)
+
+def remaining(root):
+    # Files (and empty folders, with a trailing '/') left under root.
+    left = set()
+    for cur_path, dirs, files in os.walk(str(root)):
+        rel_dir = os.path.relpath(cur_path, str(root))
+        if (not dirs) and (not files) and ('.' != rel_dir):
+            left.add(rel_dir + '/')
+        for name in files:
+            if RECORD != name:
+                left.add(os.path.normpath(os.path.join(rel_dir, name)))
+    return left
+
+def tar_tree(root, tar_path):
+    with tarfile.open(str(tar_path), 'w') as tar:
+        for name in sorted(os.listdir(str(root))):
+            tar.add(os.path.join(str(root), name), arcname=name)
+
+def tar_names(tar_path):
+    with tarfile.open(str(tar_path)) as tar:
+        return set(m.name for m in tar.getmembers() if not m.isdir())
+
+
+SUBJECT = {
+    'sub/func/task-rest_run-01/bold.nii': 'bold1',
+    'sub/func/task-rest_run-01/keep.txt': 'keep1',
+    'sub/func/task-rest_run-02/bold.nii': 'bold2',
+    'sub/func/task-rest_run-02/keep.txt': 'keep2',
+    'sub/scratch/junk': 'junk',
+    'sub/anat/T1.nii.gz': 'T1',
+    'sub/anat/T1_nonlin_init.nii.gz': 'init',
+}
+SUBJECT_RULES = {
+    'sub/func/task-rest_run-01/bold.nii': 'delete',
+    'sub/scratch/': 'delete',
+    'sub/anat/T1_nonlin_init.nii.gz': 'delete',
+}
+SUBJECT_LEFT = {
+    'sub/func/task-rest_run-01/keep.txt',
+    'sub/func/task-rest_run-02/keep.txt',
+    'sub/anat/T1.nii.gz',
+}
+
+
+@pytest.fixture
+def subject(tmp_path):
+    root = tmp_path / 'subject'
+    make_tree(root, SUBJECT)
+    rules = make_json(tmp_path / 'rules.json', SUBJECT_RULES, ['task-rest_run-*'])
+    return root, rules
+
+
+def test_normal(subject):
+    root, rules = subject
+    result = run_clean('-j', rules, '-d', root)
+    assert 0 == result.returncode, result.stderr
+    assert SUBJECT_LEFT == remaining(root)
+    assert 'Removed directory' in (root / RECORD).read_text()
+
+def test_archive(subject, tmp_path):
+    root, rules = subject
+    tar_tree(root, tmp_path / 'in.tar')
+    result = run_clean('-j', rules, '--archive', tmp_path / 'in.tar',
+                       '--archive-out', tmp_path / 'out.tar')
+    assert 0 == result.returncode, result.stderr
+    assert SUBJECT_LEFT == tar_names(tmp_path / 'out.tar')
+    # The folder being cleaned is not touched.
+    assert set(SUBJECT) == remaining(root)
+
+def test_rule_report_only(subject, tmp_path):
+    root, rules = subject
+    stats = tmp_path / 'stats.json'
+    assert 0 == run_clean('-j', rules, '-d', root, '--rule-stats', stats).returncode
+    result = run_clean('-j', rules, '--rule-stats', stats, '--rule-report')
+    assert 0 == result.returncode, result.stderr
+    assert 'Rules that never matched anything: 0' in result.stdout
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='--watch needs inotify')
+def test_watch_sweep_does_not_report_its_own_removals(subject):
+    root, rules = subject
+    os.unlink(str(root / 'sub/anat/T1_nonlin_init.nii.gz'))
+    cmd = [sys.executable, SCRIPT, '-j', rules, '-d', str(root), '--watch', '--quiet-period', '0.2']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    try:
+        # Wait for the first scan to clear what was already there.
+        deadline = time.monotonic() + 20
+        while (root / 'sub/scratch').exists() and (time.monotonic() < deadline):
+            time.sleep(0.05)
+        make_tree(root, {'sub/anat/T1_nonlin_init.nii.gz': 'init'})
+        while (root / 'sub/anat/T1_nonlin_init.nii.gz').exists() and (time.monotonic() < deadline):
+            time.sleep(0.05)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        out, err = proc.communicate(timeout=30)
+
+    assert 0 == proc.returncode, err
+    assert 'could not find' not in err
+    assert SUBJECT_LEFT == remaining(root)
+
+
+class NoWatches(object):
+    # libc, except that every inotify watch fails as if
+    # fs.inotify.max_user_watches had been reached.
+    def __init__(self, libc):
+        self.libc = libc
+
+    def __getattr__(self, name):
+        return getattr(self.libc, name)
+
+    def inotify_add_watch(self, fd, path, mask):
+        ctypes.set_errno(errno.ENOSPC)
+        return -1
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='--watch needs inotify')
+def test_watch_without_watches(tmp_path, monkeypatch, capsys):
+    root = tmp_path / 'subject'
+    make_tree(root, {'out/': '', 'out/early': 'e'})
+    monkeypatch.setattr(cleaning_script, 'base_path', str(root) + '/')
+    init = cleaning_script.InotifyWatcher.__init__
+    def init_without_watches(watcher):
+        init(watcher)
+        watcher.libc = NoWatches(watcher.libc)
+    monkeypatch.setattr(cleaning_script.InotifyWatcher, '__init__', init_without_watches)
+
+    gone_while_watching = []
+    def pipeline():
+        make_tree(root, {'out/junk': 'j'})
+        deadline = time.monotonic() + 10
+        while (root / 'out/junk').exists() and (time.monotonic() < deadline):
+            time.sleep(0.05)
+        gone_while_watching.append(not (root / 'out/junk').exists())
+        make_tree(root, {'out/late': 'l'})
+        os.kill(os.getpid(), signal.SIGTERM)
+    timer = threading.Timer(0.1, pipeline)
+    timer.start()
+
+    rules = ['out/early', 'out/junk', 'out/late']
+    not_found, success = cleaning_script.watch(rules, cleaning_script.RuleMatcher(rules),
+                                               0.2, 100, False)
+    timer.join()
+
+    # Re-scans find what inotify could not report, and the final sweep
+    # still runs.
+    assert [True] == gone_while_watching
+    assert {'out/'} == remaining(root)
+    assert 1 == capsys.readouterr().err.count('Could not watch')
+
+def clean_in_mode(mode, root, json_paths, tmp_path, *extra):
+    """
+    Cleans root (or a tar of it, for --archive) in the given mode and
+    returns what is left.
+    """
+    args = []
+    for json_path in json_paths:
+        args += ['-j', json_path]
+    args += list(extra)
+
+    if 'archive' == mode:
+        tar_tree(root, tmp_path / 'in.tar')
+        result = run_clean(*(args + ['--archive', tmp_path / 'in.tar',
+                                     '--archive-out', tmp_path / 'out.tar']))
+        assert 0 == result.returncode, result.stderr
+        return tar_names(tmp_path / 'out.tar')
+
+    args += ['-d', root]
+    if 'watch' == mode:
+        proc = subprocess.Popen([sys.executable, SCRIPT] + [str(a) for a in args]
+                                + ['--watch', '--quiet-period', '0.1'],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        # Give the first scan time to remove things before the final sweep.
+        time.sleep(1.0)
+        proc.send_signal(signal.SIGTERM)
+        out, err = proc.communicate(timeout=30)
+        assert 0 == proc.returncode, err
+        return remaining(root)
+
+    if 'paths-from' == mode:
+        path_list = tmp_path / 'paths.txt'
+        with open(str(path_list), 'w') as f:
+            for cur_path, dirs, files in os.walk(str(root)):
+                for name in sorted(dirs) + sorted(files):
+                    f.write(os.path.join(cur_path, name) + '\n')
+        args += ['--paths-from', path_list]
+    elif 'checksum-manifest' == mode:
+        args += ['--checksum-manifest', tmp_path / 'sums.txt']
+    elif 'memory-cap' == mode:
+        args += ['--memory-cap', '1']
+    elif 'free-target' == mode:
+        args += ['--free-target', '1T']
+
+    result = run_clean(*args)
+    assert 0 == result.returncode, result.stderr
+    return remaining(root)
+
+MODES = ['normal', 'archive', 'watch', 'paths-from', 'checksum-manifest', 'memory-cap',
+         'free-target']
+
+@pytest.mark.parametrize('mode', MODES)
+def test_keep_precedence_is_the_same_in_every_mode(mode, tmp_path):
+    if ('watch' == mode) and not sys.platform.startswith('linux'):
+        pytest.skip('--watch needs inotify')
+    root = tmp_path / 'subject'
+    make_tree(root, {'sub/g.txt': 'g', 'sub/k.txt': 'k', 'sub/deep/d.txt': 'd',
+                     'tmp/t.txt': 't', 'tmp/n/z.txt': 'z',
+                     'other/x.txt': 'x', 'other/y.txt': 'y'})
+    keeps = make_json(tmp_path / 'keeps.json', {'sub/': 'keep', 'sub/k.txt': 'keep',
+                                                'tmp/': 'keep'})
+    deletes = make_json(tmp_path / 'deletes.json', {'sub/': 'delete', 'tmp/': 'delete',
+                                                    'other/x.txt': 'delete'})
+
+    left = clean_in_mode(mode, root, [keeps, deletes], tmp_path, '--precedence', 'keep')
+    # Kept folders stay, their other contents follow the delete rule.
+    assert {'sub/k.txt', 'other/y.txt'} == set(p for p in left if not p.endswith('/'))
+    if 'archive' != mode:
+        assert 'tmp/' in left
+
+def test_archive_manifest_columns(subject, tmp_path):
+    root, rules = subject
+    tar_tree(root, tmp_path / 'in.tar')
+    scratch = make_json(tmp_path / 'scratch.json', {'sub/scratch/': 'delete'})
+    for json_paths, columns in (([rules], 3), ([scratch, rules], 4)):
+        args = []
+        for json_path in json_paths:
+            args += ['-j', json_path]
+        result = run_clean(*(args + ['--archive', tmp_path / 'in.tar',
+                                     '--archive-out', tmp_path / 'out.tar',
+                                     '--archive-manifest', tmp_path / 'dropped.txt']))
+        assert 0 == result.returncode, result.stderr
+        lines = (tmp_path / 'dropped.txt').read_text().splitlines()
+        assert lines
+        assert all(columns == len(line.split('\t')) for line in lines)
+
+def test_files_are_removed_before_the_folders_they_are_in(subject, tmp_path):
+    root, rules = subject
+    runs = make_json(tmp_path / 'runs.json', {'sub/func/task-rest_run-01/': 'delete'},
+                     ['task-rest_run-*'])
+    result = run_clean('-j', runs, '-j', rules, '-d', root)
+    assert 0 == result.returncode, result.stderr
+    assert 'could not find' not in result.stderr
+    assert {'sub/func/', 'sub/anat/T1.nii.gz'} == remaining(root)
+
+def test_free_target_with_nested_targets(tmp_path):
+    root = tmp_path / 'subject'
+    make_tree(root, {'scratch/big.dat': 'x' * 100000, 'scratch/small.dat': 's',
+                     'other.dat': 'o' * 50000, 'kept.dat': 'k'})
+    rules = make_json(tmp_path / 'rules.json', {'scratch/': 'delete', 'scratch/big.dat': 'delete',
+                                                'other.dat': 'delete'})
+    result = run_clean('-j', rules, '-d', root, '--free-target', '1')
+    assert 0 == result.returncode, result.stderr
+    assert {'other.dat', 'kept.dat'} == remaining(root)
+
+    record = (root / RECORD).read_text()
+    assert 'Freed about 100001 bytes' in record
+    left_in_place = record.split('Left in place:\n')[1]
+    assert 'other.dat (about 50000 bytes)' in left_in_place
+    assert 'big.dat' not in left_in_place
+
+def test_free_target_measures_what_patterns_match(tmp_path):
+    root = tmp_path / 'subject'
+    make_tree(root, {'run-01/a.dat': 'x' * 100000, 'run-02/a.dat': 'x' * 5,
+                     'mid.dat': 'm' * 50000})
+    rules = make_json(tmp_path / 'rules.json', {'run-01/': 'delete', 'run-01/a.dat': 'delete',
+                                                'mid.dat': 'delete'},
+                      ['run-*'], sizes={'run-01/a.dat': 10, 'mid.dat': 50000})
+    result = run_clean('-j', rules, '-d', root, '--free-target', '1')
+    assert 0 == result.returncode, result.stderr
+    # run-01 is the biggest on disk, whatever the JSON says.
+    assert {'run-02/a.dat', 'mid.dat'} == remaining(root)
+
+def test_daemon_cleans_and_compresses(subject, tmp_path):
+    root, rules = subject
+    make_tree(root, {'sub/anat/T1w.nii': 'T1w ' * 10000})
+    states = dict(SUBJECT_RULES)
+    states['sub/anat/T1w.nii'] = 'compress'
+    rules = make_json(tmp_path / 'compress.json', states, ['task-rest_run-*'])
+
+    sock = tmp_path / 'd.sock'
+    daemon = subprocess.Popen([sys.executable, SCRIPT, '--serve', str(sock), '--jobs', '2'],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+    try:
+        deadline = time.monotonic() + 20
+        while (not sock.exists()) and (time.monotonic() < deadline):
+            time.sleep(0.05)
+        for i in range(2):
+            result = run_clean('--connect', sock, '-j', rules, '-d', root)
+            assert 0 == result.returncode, result.stderr
+    finally:
+        daemon.send_signal(signal.SIGTERM)
+        out, err = daemon.communicate(timeout=30)
+
+    assert 0 == daemon.returncode, err
+    # No fork from a process that runs threads.
+    assert 'DeprecationWarning' not in err
+    assert SUBJECT_LEFT | {'sub/anat/T1w.nii.gz'} == remaining(root)
+
+def test_rule_stats_stay_small(tmp_path, monkeypatch):
+    stats_path = str(tmp_path / 'stats.json')
+    rule = 'sub/run-[0-9]+/missing.nii'
+    for i in range(cleaning_script.MAX_DEAD_FOLDERS + 10):
+        root = tmp_path / ('sub-%02d' % i)
+        make_tree(root, {'sub/run-01/bold.nii': 'b'})
+        monkeypatch.setattr(cleaning_script, 'base_path', str(root) + '/')
+        stats = cleaning_script.RuleStats(stats_path)
+        stats.record_rule(rule, 0, 0.001)
+        stats.save()
+
+    with open(stats_path) as f:
+        dead_in = json.load(f)['rules'][rule]['dead_in']
+    assert cleaning_script.MAX_DEAD_FOLDERS == len(dead_in)
+    # The newest folders are the ones remembered.
+    assert str(root) in dead_in
+
+def test_rule_stats_count_each_pattern_once_per_run(subject, tmp_path):
+    root, rules = subject
+    runs = make_json(tmp_path / 'runs.json', {'sub/func/task-rest_run-02/': 'delete'},
+                     ['task-rest_run-*'])
+    stats = tmp_path / 'stats.json'
+    result = run_clean('-j', rules, '-j', runs, '-d', root, '--rule-stats', stats)
+    assert 0 == result.returncode, result.stderr
+    with open(str(stats)) as f:
+        assert 1 == json.load(f)['patterns']['task-rest_run-*']['runs']
+
+def walk_paths(root):
+    # Every folder and file under root, like find(1) lists them.
+    paths = []
+    for cur_path, dirs, files in os.walk(str(root)):
+        dirs.sort()
+        for name in sorted(files):
+            paths.append(os.path.join(cur_path, name))
+        for name in dirs:
+            paths.append(os.path.join(cur_path, name))
+    return paths
+
+@pytest.mark.parametrize('separator', ['\n', '\0'])
+def test_paths_from(subject, tmp_path, separator):
+    root, rules = subject
+    path_list = tmp_path / 'paths.txt'
+    path_list.write_text(separator.join(walk_paths(root)) + separator)
+    args = ['-j', rules, '-d', root, '--paths-from', path_list]
+    if '\0' == separator:
+        args.append('-0')
+    result = run_clean(*args)
+    assert 0 == result.returncode, result.stderr
+    assert SUBJECT_LEFT == remaining(root)
+    # The folder is removed once, not once per file in it.
+    assert 1 == (root / RECORD).read_text().count('scratch')
+
+def test_paths_from_stdin_print_matches(subject):
+    root, rules = subject
+    # Relative paths are taken relative to -d.
+    listing = '\n'.join(os.path.relpath(p, str(root)) for p in walk_paths(root)) + '\n'
+    result = run_clean('-j', rules, '-d', root, '--paths-from', '-', '--print-matches',
+                       input=listing)
+    assert 0 == result.returncode, result.stderr
+    assert set(SUBJECT) == remaining(root)
+    printed = set(os.path.relpath(p, str(root)) for p in result.stdout.split('\n') if p)
+    assert {'sub/func/task-rest_run-01/bold.nii', 'sub/func/task-rest_run-02/bold.nii',
+            'sub/scratch', 'sub/anat/T1_nonlin_init.nii.gz'} == printed
+
+def read_manifest(manifest_path):
+    with open(str(manifest_path)) as manifest:
+        header = manifest.readline()
+        entries = {}
+        for line in manifest:
+            path, size, mtime_ns, digest = line.rstrip('\n').split('\t')
+            entries[path] = (int(size), digest)
+    return header, entries
+
+def test_checksum_manifest(subject, tmp_path):
+    root, rules = subject
+    manifest_path = tmp_path / 'sums.txt'
+    result = run_clean('-j', rules, '-d', root, '--checksum-manifest', manifest_path)
+    assert 0 == result.returncode, result.stderr
+    assert SUBJECT_LEFT == remaining(root)
+
+    header, entries = read_manifest(manifest_path)
+    assert header.endswith('sha256\n')
+    assert SUBJECT_LEFT == set(entries)
+    for rel_path, (size, digest) in entries.items():
+        contents = SUBJECT[rel_path].encode()
+        assert (len(contents), hashlib.sha256(contents).hexdigest()) == (size, digest)
+
+    # Nothing changed, so the second run reuses every digest.
+    result = run_clean('-j', rules, '-d', root, '--checksum-manifest', manifest_path)
+    assert 0 == result.returncode, result.stderr
+    assert '(3 unchanged, digest reused)' in (root / RECORD).read_text()
+    assert entries == read_manifest(manifest_path)[1]
+
+def test_memory_cap(tmp_path):
+    root = tmp_path / 'subject'
+    files = {'scratch/a/junk': 'j', 'keep.txt': 'k'}
+    for run in range(1, cleaning_script.MAX_MERGE + 20):
+        files['func/run-%02d/bold.nii' % run] = 'b'
+        files['func/run-%02d/keep.txt' % run] = 'k'
+    make_tree(root, files)
+    rules = make_json(tmp_path / 'rules.json', {'func/run-01/bold.nii': 'delete',
+                                                'scratch/': 'delete',
+                                                'scratch/a/junk': 'delete'}, ['run-*'])
+    spill_dir = tmp_path / 'spill'
+    spill_dir.mkdir()
+
+    # A one-byte cap puts every target in its own run, so the runs are
+    # merged in more than one pass.
+    result = run_clean('-j', rules, '-d', root, '--memory-cap', '1', '--spill-dir', spill_dir)
+    assert 0 == result.returncode, result.stderr
+    assert 'could not find' not in result.stderr
+    assert set(p for p in files if p.endswith('keep.txt')) == remaining(root)
+    assert [] == os.listdir(str(spill_dir))
+
+    record = (root / RECORD).read_text()
+    assert cleaning_script.MAX_MERGE + 19 == record.count('bold.nii')
+    # The file inside the removed folder is not handled on its own.
+    assert 'junk' not in record
+
+def test_archive_strip_components(subject, tmp_path):
+    root, rules = subject
+    # tarfile stores the first of these it comes to (sub/scratch/junk) with
+    # the data, and the others as hard links to it.
+    os.link(str(root / 'sub/scratch/junk'), str(root / 'sub/zz-junk-link'))
+    os.link(str(root / 'sub/scratch/junk'), str(root / 'sub/zz-junk-link2'))
+    os.link(str(root / 'sub/anat/T1.nii.gz'), str(root / 'sub/scratch/T1-link'))
+    with tarfile.open(str(tmp_path / 'in.tar.gz'), 'w:gz') as tar:
+        tar.add(str(root), arcname='sub-01')
+
+    result = run_clean('-j', rules, '--archive', tmp_path / 'in.tar.gz', '--strip-components', '1',
+                       '--archive-out', tmp_path / 'out.tar.xz')
+    assert 0 == result.returncode, result.stderr
+    # Members are kept or dropped by their own path, links or not.
+    kept = SUBJECT_LEFT | {'sub/zz-junk-link', 'sub/zz-junk-link2'}
+    assert set('sub-01/' + p for p in kept) == tar_names(tmp_path / 'out.tar.xz')
+
+    out = tmp_path / 'out'
+    with tarfile.open(str(tmp_path / 'out.tar.xz')) as tar:
+        tar.extractall(str(out))
+    assert 'junk' == (out / 'sub-01/sub/zz-junk-link').read_text()
+    assert 'junk' == (out / 'sub-01/sub/zz-junk-link2').read_text()
+    assert 'T1' == (out / 'sub-01/sub/anat/T1.nii.gz').read_text()
+
+    dropped = (tmp_path / 'out.tar.xz.dropped.txt').read_text().splitlines()
+    dropped_names = set(line.split('\t')[0] for line in dropped)
+    assert {'sub-01/sub/scratch/junk', 'sub-01/sub/scratch/T1-link'} <= dropped_names
+    assert not any('zz-junk-link' in name for name in dropped_names)
+    assert 'sub-01/sub/scratch/junk\t4\tsub/scratch' in dropped
+
+def test_patterned_rules_expand_in_normal_runs(tmp_path):
+    root = tmp_path / 'subject'
+    make_tree(root, {'run-1/bold.nii': 'b', 'run-22/bold.nii': 'b', 'run-x/bold.nii': 'b',
+                     'run-3/sub/bold.nii': 'b'})
+    rules = make_json(tmp_path / 'rules.json', {'run-1/bold.nii': 'delete'}, ['run-*'])
+    result = run_clean('-j', rules, '-d', root)
+    assert 0 == result.returncode, result.stderr
+    # run-[0-9]+ only stands for digits, and only within one path component.
+    assert {'run-1/', 'run-22/', 'run-x/bold.nii', 'run-3/sub/bold.nii'} == remaining(root)
+
+def test_serve_leaves_other_files_alone(tmp_path):
+    not_a_socket = tmp_path / 'notasock'
+    not_a_socket.write_text('important')
+    result = run_clean('--serve', not_a_socket)
+    assert 1 == result.returncode
+    assert 'not a socket' in result.stderr
+    assert 'important' == not_a_socket.read_text()
+
+def test_rule_stats_order_does_not_change_removal_order(tmp_path, monkeypatch):
+    root = tmp_path / 'subject'
+    make_tree(root, {'scratch/a.dat': 'a', 'b.dat': 'b'})
+    monkeypatch.setattr(cleaning_script, 'base_path', str(root) + '/')
+    stats = cleaning_script.RuleStats(str(tmp_path / 'stats.json'))
+    # The folder rule is the cheapest, so it is expanded first.
+    for rule, cost in (('scratch/a.dat', 2.0), ('b.dat', 1.0), ('scratch', 0.5)):
+        stats.record_rule(rule, 1, cost)
+    expanded = []
+    make_paths = cleaning_script.make_paths
+    monkeypatch.setattr(cleaning_script, 'make_paths',
+                        lambda rules: expanded.extend(rules) or make_paths(rules))
+
+    rules = ['scratch/a.dat', 'b.dat', 'scratch']
+    targets = cleaning_script.make_targets(rules, cleaning_script.RuleMatcher(rules), stats)
+    assert ['scratch', 'b.dat', 'scratch/a.dat'] == expanded
+    assert rules == list(targets.values())
+
+def test_compress(tmp_path):
+    root = tmp_path / 'subject'
+    make_tree(root, {'sub/a.nii': 'a' * 10000, 'sub/c.nii.gz': 'c' * 10000})
+    # Already compressed, whatever the name says.
+    with open(str(root / 'sub/b.nii'), 'wb') as f:
+        f.write(b'\x1f\x8b' + b'b' * 10000)
+    rules = make_json(tmp_path / 'rules.json', {'sub/a.nii': 'compress', 'sub/b.nii': 'compress',
+                                                'sub/c.nii.gz': 'compress'})
+    result = run_clean('-j', rules, '-d', root)
+    assert 0 == result.returncode, result.stderr
+    assert {'sub/a.nii.gz', 'sub/b.nii', 'sub/c.nii.gz'} == remaining(root)
+    assert 'c' * 10000 == (root / 'sub/c.nii.gz').read_text()
+    with gzip.open(str(root / 'sub/a.nii.gz'), 'rt') as f:
+        assert 'a' * 10000 == f.read()
+    record = (root / RECORD).read_text()
+    assert re.search(r'Compressed file \S+/sub/a\.nii to \S+/sub/a\.nii\.gz, saved \d+ bytes', record)
+    assert 'b.nii to' not in record
+
+    # Nothing is missing the second time round.
+    result = run_clean('-j', rules, '-d', root)
+    assert 0 == result.returncode, result.stderr
+    assert 'could not find' not in result.stderr
+    assert {'sub/a.nii.gz', 'sub/b.nii', 'sub/c.nii.gz'} == remaining(root)
+
+def test_paths_from_dot_dot_names(tmp_path):
+    root = tmp_path / 'subject'
+    make_tree(root, {'..hidden/junk': 'j', 'other': 'o'})
+    rules = make_json(tmp_path / 'rules.json', {'..hidden/junk': 'delete'})
+    listing = '..hidden/junk\n../subject/other\n'
+    result = run_clean('-j', rules, '-d', root, '--paths-from', '-', input=listing)
+    assert 0 == result.returncode, result.stderr
+    assert {'..hidden/', 'other'} == remaining(root)
+
+def test_checksum_manifest_with_compress(subject, tmp_path):
+    root, rules = subject
+    make_tree(root, {'sub/anat/T1w.nii': 'T1w ' * 10000})
+    states = dict(SUBJECT_RULES)
+    states['sub/anat/T1w.nii'] = 'compress'
+    rules = make_json(tmp_path / 'compress.json', states, ['task-rest_run-*'])
+    manifest_path = tmp_path / 'sums.txt'
+    result = run_clean('-j', rules, '-d', root, '--checksum-manifest', manifest_path,
+                       '--jobs', '2')
+    assert 0 == result.returncode, result.stderr
+    # No fork while the hashing threads run.
+    assert 'DeprecationWarning' not in result.stderr
+    assert SUBJECT_LEFT | {'sub/anat/T1w.nii.gz'} == set(read_manifest(manifest_path)[1])
@@ -0,0 +1,21 @@
+import os
+import io
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rule_tree
+
+
+def test_round_trip():
+    data = rule_tree.make_test_data(3)['file_system_data']
+    assert data == rule_tree.to_json(rule_tree.from_json(data))
+
+def test_round_trip_without_size():
+    data = {'a': {'name': 'a', 'type': 'folder', 'state': 'keep', 'rel_path': 'a',
+                  'children': {'b': {'name': 'b', 'type': 'file', 'state': 'delete',
+                                     'rel_path': 'a/b', 'size': 3, 'note': 'x'}}}}
+    loaded = rule_tree.load(io.StringIO(json.dumps({'file_system_data': data})))
+    assert data == rule_tree.to_json(loaded['file_system_data'])
+    assert data == rule_tree.to_json(rule_tree.from_json(data))